@@ -0,0 +1,152 @@
+"""Synthetic csv files with the headers of the staging tables.
+
+The files are reproducible from their seed. A share of the rows is invalid
+(`error_rate`) and a share of them deletes a key generated earlier in the file
+(`delete_ratio`).
+"""
+import csv
+import random
+import sys
+import typing as t
+from datetime import date, timedelta
+
+import click
+
+from idfp.definitions import Type
+
+HEADERS = {
+    Type.AREA: [
+        "IsDeleted",
+        "Operation",
+        "LicenseNumber",
+        "LicenseeId",
+        "ExternalIdentifier",
+        "CreatedBy",
+        "UpdatedBy",
+        "CreatedDate",
+        "UpdatedDate",
+        "Area",
+        "Name",
+        "AreaId",
+        "IsQuarantine",
+    ],
+    Type.STRAIN: [
+        "IsDeleted",
+        "Operation",
+        "LicenseNumber",
+        "LicenseeId",
+        "CreatedBy",
+        "UpdatedBy",
+        "CreatedDate",
+        "UpdatedDate",
+        "StrainId",
+        "AssociateId",
+        "StrainType",
+        "Name",
+    ],
+}
+
+KEY_FIELDS = {Type.AREA: "ExternalIdentifier", Type.STRAIN: "StrainId"}
+
+# a value of each field that fails validation
+INVALID_VALUES = {
+    "LicenseeId": "not a number",
+    "CreatedBy": "x" * 40,
+    "CreatedDate": "31/12/2024",
+    "UpdatedDate": "yesterday",
+    "Name": "x" * 120,
+    "AreaId": "1.5",
+    "IsQuarantine": "maybe",
+    "AssociateId": "",
+    "StrainType": "Ruderalis",
+}
+
+
+def _key(type: Type, n: int) -> str:
+    return f"EXT{n:09d}" if type is Type.AREA else str(n)
+
+
+def _valid_row(type: Type, rnd: random.Random, key: str, n: int) -> dict[str, str]:
+    created = date(2024, 1, 1) + timedelta(days=rnd.randrange(365))
+    row = {
+        "IsDeleted": "False",
+        "Operation": "Insert",
+        "LicenseNumber": str(rnd.randrange(100000, 999999)),
+        "LicenseeId": str(rnd.randrange(1, 10000)),
+        "CreatedBy": f"user{rnd.randrange(100)}",
+        "UpdatedBy": rnd.choice(["", f"user{rnd.randrange(100)}"]),
+        "CreatedDate": created.isoformat(),
+        "UpdatedDate": rnd.choice(
+            ["", (created + timedelta(days=rnd.randrange(30))).isoformat()]
+        ),
+        "Name": f"{type.value} {n}",
+    }
+    if type is Type.AREA:
+        row.update(
+            ExternalIdentifier=key,
+            Area="",
+            AreaId=str(n),
+            IsQuarantine=rnd.choice(["True", "False"]),
+        )
+    else:
+        row.update(
+            StrainId=key,
+            AssociateId=str(rnd.randrange(1, 1000)),
+            StrainType=rnd.choice(["Indica", "Sativa", "Hybrid"]),
+        )
+    return row
+
+
+def generate_rows(
+    type: Type,
+    rows: int,
+    *,
+    error_rate: float = 0.01,
+    delete_ratio: float = 0.1,
+    seed: int = 0,
+) -> t.Iterator[list[str]]:
+    """The header then `rows` data rows of a `type` csv file"""
+    rnd = random.Random(seed)
+    headers = HEADERS[type]
+    key_field = KEY_FIELDS[type]
+    yield headers
+    for n in range(rows):
+        if n and rnd.random() < delete_ratio:
+            row = {h: "" for h in headers}
+            row.update(
+                IsDeleted="True",
+                Operation="Delete",
+                **{key_field: _key(type, rnd.randrange(n))},
+            )
+        else:
+            row = _valid_row(type, rnd, _key(type, n), n)
+            if rnd.random() < error_rate:
+                field = rnd.choice([f for f in INVALID_VALUES if f in row])
+                row[field] = INVALID_VALUES[field]
+        yield [row[h] for h in headers]
+
+
+def generate_csv(fo: t.TextIO, type: Type, rows: int, **kwargs):
+    csv.writer(fo).writerows(generate_rows(type, rows, **kwargs))
+
+
+@click.command()
+@click.argument("type_str", metavar="TYPE", type=click.Choice([t.value for t in HEADERS]))
+@click.argument("rows", type=click.IntRange(min=0))
+@click.option("--error-rate", default=0.01, type=click.FloatRange(0, 1))
+@click.option("--delete-ratio", default=0.1, type=click.FloatRange(0, 1))
+@click.option("--seed", default=0, type=int)
+def main(type_str: str, rows: int, error_rate: float, delete_ratio: float, seed: int):
+    """Write a synthetic csv file to the standard output"""
+    generate_csv(
+        sys.stdout,
+        Type(type_str),
+        rows,
+        error_rate=error_rate,
+        delete_ratio=delete_ratio,
+        seed=seed,
+    )
+
+
+if __name__ == "__main__":
+    main()
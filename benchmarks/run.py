@@ -0,0 +1,230 @@
+"""Import throughput benchmark.
+
+Every case imports a synthetic file (see generate.py) with
+`import_and_process_csv` in a fresh process and reports the duration of each
+phase, the rows per second, the peak RSS and the phase counters recorded on
+the source as JSON. Run it against a database dedicated to benchmarks,
+`--truncate` empties the entity tables.
+
+    python benchmarks/run.py -c config.toml --rows 10000 --rows 100000 --mode bulk
+"""
+import concurrent.futures
+import functools
+import importlib.metadata
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import typing as t
+
+import click
+from psycopg2 import sql
+
+from idfp.config import AppConfiguration, configure
+from idfp.db import get_db_conn
+from idfp.definitions import DATA_MAPPING, ProcessMode, Type
+
+from generate import generate_csv
+
+
+def _timed(phases: dict[str, float], name: str, func: t.Callable) -> t.Callable:
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            phases[name] = phases.get(name, 0) + time.perf_counter() - start
+
+    return wrapper
+
+
+def _peak_rss() -> int:
+    """Peak RSS in bytes of this process and of its largest child"""
+    return 1024 * max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+
+def run_case(config: AppConfiguration, case: dict[str, t.Any]) -> dict[str, t.Any]:
+    """Run a benchmark case, in a process of its own for the peak RSS"""
+    from idfp.importers import base, stream
+
+    type = Type(case["type"])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, f"{type.value}.csv")
+        with open(path, "w", newline="") as fo:
+            generate_csv(
+                fo,
+                type,
+                case["rows"],
+                error_rate=case["error_rate"],
+                delete_ratio=case["delete_ratio"],
+                seed=case["seed"],
+            )
+
+        with get_db_conn(config) as db_conn:
+            if case["truncate"]:
+                with db_conn.cursor() as cur:
+                    cur.execute(
+                        sql.SQL("truncate {}").format(
+                            sql.Identifier(DATA_MAPPING[type].table)
+                        )
+                    )
+                db_conn.commit()
+
+            phases: dict[str, float] = {}
+            # the source is stamped on the staged rows while copying
+            base.import_csv = _timed(phases, "copy", base.import_csv)
+            if case["stream"]:
+                stream.stream_csv = _timed(phases, "stream", stream.stream_csv)
+            else:
+                # run by process_csv, before insert and delete
+                base.dedup_source = _timed(phases, "dedup", base.dedup_source)
+                if case["workers"] > 1:
+                    # insert and delete run in the worker processes, process
+                    # includes the dedup
+                    base.process_csv = _timed(phases, "process", base.process_csv)
+                else:
+                    base.process_csv_insert = _timed(
+                        phases, "insert", base.process_csv_insert
+                    )
+                    base.process_csv_delete = _timed(
+                        phases, "delete", base.process_csv_delete
+                    )
+            start = time.perf_counter()
+            with open(path) as csv_fo:
+                source_id = base.import_and_process_csv(
+                    db_conn=db_conn,
+                    type=type,
+                    csv_fo=csv_fo,
+                    mode=ProcessMode(case["mode"]),
+                    workers=case["workers"],
+                    config=config,
+                    stream=case["stream"],
+                )
+            total = time.perf_counter() - start
+            with db_conn.cursor() as cur:
+                cur.execute("select stats from sources where id = %s", [source_id])
+                source_stats = cur.fetchone()[0]
+
+    return {
+        **case,
+        "phases": {name: round(seconds, 4) for name, seconds in phases.items()},
+        "total": round(total, 4),
+        "rows_per_second": round(case["rows"] / total, 1),
+        "peak_rss_bytes": _peak_rss(),
+        # counters of the phases, summed over the workers
+        "stats": source_stats,
+    }
+
+
+def _environment(config: AppConfiguration) -> dict[str, t.Any]:
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        revision = ""
+    with get_db_conn(config) as db_conn:
+        with db_conn.cursor() as cur:
+            cur.execute("show server_version")
+            server_version = cur.fetchone()[0]
+    return {
+        "idfp_version": importlib.metadata.version("idfp"),
+        "git_revision": revision or None,
+        "python_version": platform.python_version(),
+        "postgres_version": server_version,
+        "cpu_count": os.cpu_count(),
+    }
+
+
+@click.command()
+@click.option("--config", "-c", "config_fo", required=True, type=click.File("rb"))
+@click.option(
+    "--type",
+    "type_strs",
+    multiple=True,
+    default=[Type.AREA.value],
+    type=click.Choice([t.value for t in Type]),
+)
+@click.option("--rows", multiple=True, default=[10000], type=click.IntRange(min=1))
+@click.option("--error-rate", default=0.01, type=click.FloatRange(0, 1))
+@click.option("--delete-ratio", default=0.1, type=click.FloatRange(0, 1))
+@click.option(
+    "--mode",
+    "mode_strs",
+    multiple=True,
+    default=[ProcessMode.ROW.value],
+    type=click.Choice([m.value for m in ProcessMode]),
+)
+@click.option("--workers", default=1, type=click.IntRange(min=1))
+@click.option("--stream", is_flag=True)
+@click.option("--repeat", default=1, type=click.IntRange(min=1))
+@click.option("--seed", default=0, type=int)
+@click.option(
+    "--truncate", is_flag=True, help="Empty the entity table before each case"
+)
+@click.option("--output", "-o", "output_fo", default="-", type=click.File("w"))
+def main(
+    config_fo: t.BinaryIO,
+    type_strs: tuple[str, ...],
+    rows: tuple[int, ...],
+    error_rate: float,
+    delete_ratio: float,
+    mode_strs: tuple[str, ...],
+    workers: int,
+    stream: bool,
+    repeat: int,
+    seed: int,
+    truncate: bool,
+    output_fo: t.TextIO,
+):
+    """Benchmark the csv importer, write the results as JSON"""
+    config = configure(config_fo)
+    cases = [
+        {
+            "type": type_str,
+            "rows": n,
+            "error_rate": error_rate,
+            "delete_ratio": delete_ratio,
+            "mode": mode_str,
+            "workers": workers,
+            "stream": stream,
+            "seed": seed,
+            "truncate": truncate,
+            "run": run,
+        }
+        for type_str in type_strs
+        for n in rows
+        for mode_str in mode_strs
+        for run in range(repeat)
+    ]
+    results = []
+    for case in cases:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            result = executor.submit(run_case, config, case).result()
+        print(
+            f"{result['type']} {result['rows']} rows "
+            f"{'stream' if result['stream'] else result['mode']}: "
+            f"{result['rows_per_second']} rows/s",
+            file=sys.stderr,
+        )
+        results.append(result)
+    json.dump({**_environment(config), "results": results}, output_fo, indent=2)
+    output_fo.write("\n")
+
+
+if __name__ == "__main__":
+    main()
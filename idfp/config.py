@@ -31,6 +31,25 @@ class AppConfiguration:
     web_workers: t.Optional[int] = None
     web_preload: bool = False
     web_reuse_port: bool = False
+    # seconds a web worker may spend on a request, uploads are staged in it
+    web_timeout: int = 30
+    db_pool_minconn: int = 1
+    db_pool_maxconn: int = 4
+    db_reader_pool_minconn: int = 1
+    db_reader_pool_maxconn: int = 4
+    sources_page_size: int = 100
+    query_row_limit: int = 1000
+    # milliseconds
+    query_statement_timeout: int = 30000
+    # "", "memory" or "file"
+    query_cache: str = ""
+    # seconds
+    query_cache_ttl: int = 300
+    query_cache_max_bytes: int = 64 * 1024 * 1024
+    query_cache_dir: str = ""
+    # prometheus_client multiprocess directory, shared by the web workers
+    # and the importers
+    metrics_dir: str = ""
 
 
 class AppF(BaseModel):
@@ -47,6 +66,25 @@ class AppF(BaseModel):
     web_workers: t.Optional[int] = None
     web_preload: bool = False
     web_reuse_port: bool = False
+    # seconds a web worker may spend on a request, uploads are staged in it
+    web_timeout: int = 30
+    db_pool_minconn: int = 1
+    db_pool_maxconn: int = 4
+    db_reader_pool_minconn: int = 1
+    db_reader_pool_maxconn: int = 4
+    sources_page_size: int = 100
+    query_row_limit: int = 1000
+    # milliseconds
+    query_statement_timeout: int = 30000
+    # "", "memory" or "file"
+    query_cache: str = ""
+    # seconds
+    query_cache_ttl: int = 300
+    query_cache_max_bytes: int = 64 * 1024 * 1024
+    query_cache_dir: str = ""
+    # prometheus_client multiprocess directory, shared by the web workers
+    # and the importers
+    metrics_dir: str = ""
 
 
 class AppConfigurationF(BaseModel):
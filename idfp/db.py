@@ -1,7 +1,20 @@
+import os
+
 import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
 
 from idfp.config import AppConfiguration
 
+# notified with the source id whenever a source finishes processing
+SOURCE_PROCESSED_CHANNEL = "idfp_source_processed"
+# notified with the source id whenever a source is queued for the workers
+SOURCE_QUEUED_CHANNEL = "idfp_source_queued"
+
+_pools: dict[bool, ThreadedConnectionPool] = {}
+_pools_pid: int = os.getpid()
+# pools inherited from a parent process, their connections belong to it
+_parent_pools: list[ThreadedConnectionPool] = []
+
 
 def get_db_conn(config: AppConfiguration):
     return psycopg2.connect(
@@ -21,3 +34,59 @@ def get_db_reader_conn(config: AppConfiguration):
         host=config.dbhost,
         port=config.dbport,
     )
+
+
+def notify_source_processed(cur, source_id: int):
+    # delivered on commit
+    cur.execute("select pg_notify(%s, %s)", [SOURCE_PROCESSED_CHANNEL, str(source_id)])
+
+
+def notify_source_queued(cur, source_id: int):
+    # delivered on commit
+    cur.execute("select pg_notify(%s, %s)", [SOURCE_QUEUED_CHANNEL, str(source_id)])
+
+
+def get_db_pool(config: AppConfiguration, *, reader: bool = False):
+    """Connection pool of the writer or reader role for the current process.
+
+    Pools are created on first use, so that each forked gunicorn worker
+    connects on its own instead of sharing the sockets of the master.
+    """
+    global _pools_pid
+    if _pools_pid != os.getpid():
+        # keep them referenced, closing or garbage collecting the connections
+        # would terminate the sessions of the parent too
+        _parent_pools.extend(_pools.values())
+        _pools.clear()
+        _pools_pid = os.getpid()
+
+    if reader not in _pools:
+        if reader:
+            _pools[reader] = ThreadedConnectionPool(
+                config.db_reader_pool_minconn,
+                config.db_reader_pool_maxconn,
+                database=config.dbname,
+                user=config.dbreaderuser,
+                password=config.dbreaderpassword,
+                host=config.dbhost,
+                port=config.dbport,
+            )
+        else:
+            _pools[reader] = ThreadedConnectionPool(
+                config.db_pool_minconn,
+                config.db_pool_maxconn,
+                database=config.dbname,
+                user=config.dbuser,
+                password=config.dbpassword,
+                host=config.dbhost,
+                port=config.dbport,
+            )
+    return _pools[reader]
+
+
+def close_db_pools():
+    if _pools_pid != os.getpid():
+        return
+    for pool in _pools.values():
+        pool.closeall()
+    _pools.clear()
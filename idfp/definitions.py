@@ -10,6 +10,14 @@ class Type(str, Enum):
     AREA = "area"
     STRAIN = "strain"
 
+
+class ProcessMode(str, Enum):
+    # one statement per row, the original behaviour
+    ROW = "row"
+    # one set-based statement per fetched batch
+    BULK = "bulk"
+
+
 # might be `_id`?
 CSV_ID_FIELD = "id"
 
@@ -21,6 +29,11 @@ class TypeConfig:
     csv_table: str
     table: str
 
+    @property
+    def primary_key_field(self) -> str:
+        # the model field behind the lowercased `primary_key` column
+        return next(f for f in self.model.model_fields if f.lower() == self.primary_key)
+
 
 @dataclass
 class Source:
@@ -8,7 +8,12 @@ from datetime import datetime, timezone
 from psycopg2 import sql
 from psycopg2._psycopg import connection
 
+from idfp.db import notify_source_processed
+from idfp.definitions import Type
+from idfp.importers.csv_io import SourceStampedCsv
+from idfp.importers.errors import CsvErrorSink, update_source_errors_count
 from idfp.models import Area
+from idfp.partitions import create_source_partitions
 from pydantic import ValidationError
 
 
@@ -35,6 +40,7 @@ def import_area_csv(
         insert_source_result = cur.fetchone()
         assert insert_source_result is not None
         source_id: int = insert_source_result[0]
+        create_source_partitions(cur, Type.AREA, source_id)
         db_conn.commit()
 
     try:
@@ -47,7 +53,7 @@ def import_area_csv(
         sql_cols = [sql.Identifier(h.lower()) for h in headers]
         with db_conn.cursor() as cur:
             copy_sql = sql.SQL(
-                f"COPY {{}}({sql_col_placeholders}) FROM STDIN DELIMITER E{{}} CSV QUOTE {{}}"
+                f"COPY {{}}(source_id, processed_at, {sql_col_placeholders}) FROM STDIN DELIMITER E{{}} CSV QUOTE {{}}"
             ).format(
                 sql.Identifier("area_csv"),
                 *sql_cols,
@@ -56,20 +62,10 @@ def import_area_csv(
             )
             cur.copy_expert(
                 copy_sql,
-                csv_fd,
-            )
-            set_source_id_sql = sql.SQL(
-                "update {} set source_id = %s where source_id is null"
-            ).format(
-                sql.Identifier("area_csv"),
-            )
-            cur.execute(set_source_id_sql, [source_id])
-            set_processed_at_sql = sql.SQL(
-                "update {} set processed_at = 0 where source_id = %s"
-            ).format(
-                sql.Identifier("area_csv"),
+                SourceStampedCsv(
+                    csv_fd, [source_id, 0], delimiter=delimiter, quotechar=quotechar
+                ),
             )
-            cur.execute(set_processed_at_sql, [source_id])
             db_conn.commit()
     except Exception as exc:
         db_conn.rollback()
@@ -92,6 +88,7 @@ def process_area_csv_insert(db_conn: connection, source_id: int):
         f"select {area_csv_fields_select} from {{}} where source_id = %s and LOWER(IsDeleted) = 'false' and processed_at = 0"
     ).format(sql.Identifier("area_csv"))
     with db_conn.cursor() as cur1, db_conn.cursor() as cur2:
+        error_sink = CsvErrorSink(cur2, source_id, "area_csv")
         cur1.execute(get_insert_sql, [source_id])
         while True:
             insert_data = []
@@ -109,20 +106,8 @@ def process_area_csv_insert(db_conn: connection, source_id: int):
                     # TODO: check if ExternalIdentifier exists
                     insert_data.append(list(fields_values.values()))
                 except ValidationError as err:
-                    cur2.execute(
-                        sql.SQL(
-                            "update {} set processed_at = %s, errors = %s where id = %s"
-                        ).format(sql.Identifier("area_csv")),
-                        [int(time.time()), err.json(), row[len(area_csv_fields) - 1]],
-                    )
-                    cur2.execute(
-                        "insert into csv_errors(source_id, record_id, errors) values(%s, %s, %s)",
-                        [
-                            source_id,
-                            row[len(area_csv_fields) - 1],
-                            err.json(),
-                        ],
-                    )
+                    error_sink.add(row[len(area_csv_fields) - 1], err.json())
+            error_sink.flush()
 
             values_placeholder = ", ".join(["%s"] * len(area_fields))
             cur2.executemany(
@@ -132,10 +117,10 @@ def process_area_csv_insert(db_conn: connection, source_id: int):
                 insert_data,
             )
             cur2.execute(
-                sql.SQL("update {} set processed_at = %s where id in %s").format(
-                    sql.Identifier("area_csv")
-                ),
-                [int(time.time()), tuple(csv_row_ids)],
+                sql.SQL(
+                    "update {} set processed_at = %s where source_id = %s and id in %s"
+                ).format(sql.Identifier("area_csv")),
+                [int(time.time()), source_id, tuple(csv_row_ids)],
             )
             db_conn.commit()
 
@@ -145,6 +130,7 @@ def process_area_csv_delete(db_conn: connection, source_id: int):
         f"select externalidentifier, id from {{}} where source_id = %s and LOWER(IsDeleted) = 'true' and processed_at = 0"
     ).format(sql.Identifier("area_csv"))
     with db_conn.cursor() as cur1, db_conn.cursor() as cur2:
+        error_sink = CsvErrorSink(cur2, source_id, "area_csv")
         cur1.execute(get_insert_sql, [source_id])
         while True:
             csv_row_ids: list[int] = []
@@ -161,34 +147,29 @@ def process_area_csv_delete(db_conn: connection, source_id: int):
                 if cur2.rowcount != 0:
                     csv_row_ids.append(row[1])
                 else:
-                    cur2.execute(
-                        "update area_csv set processed_at = %s where id = %s",
-                        [
-                            int(time.time()),
-                            row[1],
-                        ],
-                    )
-                    cur2.execute(
-                        "insert into csv_errors(source_id, record_id, errors) values(%s, %s, %s)",
-                        [
-                            source_id,
-                            row[1],
-                            json.dumps(
-                                {"message": "ExternalIdentifier does not exist"}
-                            ),
-                        ],
+                    error_sink.add(
+                        row[1],
+                        json.dumps({"message": "ExternalIdentifier does not exist"}),
                     )
+            error_sink.flush()
             if csv_row_ids:
                 cur2.execute(
-                    "update area_csv set processed_at = %s where id in %s",
-                    [int(time.time()), tuple(csv_row_ids)],
+                    "update area_csv set processed_at = %s where source_id = %s and id in %s",
+                    [int(time.time()), source_id, tuple(csv_row_ids)],
                 )
             db_conn.commit()
 
 
 def process_area_csv(db_conn: connection, source_id: int):
     with db_conn.cursor() as cur:
-        cur.execute("update sources set processed_at = now() where id=%s", [source_id])
+        cur.execute(
+            "update sources set processing_started_at = now() where id=%s", [source_id]
+        )
         db_conn.commit()
     process_area_csv_insert(db_conn, source_id)
     process_area_csv_delete(db_conn, source_id)
+    with db_conn.cursor() as cur:
+        cur.execute("update sources set processed_at = now() where id=%s", [source_id])
+        update_source_errors_count(cur, source_id)
+        notify_source_processed(cur, source_id)
+        db_conn.commit()
@@ -1,47 +1,130 @@
+import collections
 import csv
-import itertools
 import logging
 import json
 import time
 import typing as t
 import os
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timezone
+from functools import partial
 
+import psycopg2
 from psycopg2 import sql
-from psycopg2._psycopg import connection
+from psycopg2._psycopg import connection, cursor
 
-from idfp.definitions import Type, DATA_MAPPING, Source, CSV_ID_FIELD
-from pydantic import ValidationError
+from idfp.config import AppConfiguration
+from idfp.db import get_db_conn, notify_source_processed
+from idfp.definitions import Type, DATA_MAPPING, Source, CSV_ID_FIELD, ProcessMode
+from idfp.importers.csv_io import SourceStampedCsv
+from idfp.partitions import create_source_partitions
+from idfp.importers.errors import CsvErrorSink, update_source_errors_count
+from idfp.importers.stats import PhaseStats
+from idfp.importers.statements import (
+    PreparedStatement,
+    get_delete_statement,
+    get_mark_processed_statement,
+    get_upsert_statement,
+)
+from idfp.importers.validation import get_batch_validator
+from pydantic import TypeAdapter, ValidationError
 
 logger = logging.getLogger(__name__)
 
 
-def import_csv(
-    db_conn: connection,
-    type: Type,
-    csv_fd: t.TextIO,
-    *,
-    delimiter: str = ",",
-    quotechar: t.Optional[str] = None,
-):
-    if not quotechar:
-        quotechar = '"'
+def create_source(db_conn: connection, type: Type, filename: str) -> int:
+    """Create a source locked for the caller, who releases it once the file is
+    staged (see `release_source`). number_of_records stays null until then, a
+    source left like that without its lock was abandoned while staging (see
+    `idfp.importers.queue.fail_abandoned_sources`)."""
     with db_conn.cursor() as cur:
         cur.execute(
             "insert into sources(type, filename, submitted_by, submitted_date, number_of_records) values (%s, %s, %s, %s, %s) returning id",
             [
                 type.value,
-                os.path.basename(csv_fd.name),
+                filename,
                 "",
                 datetime.now(timezone.utc).date(),
-                0,
+                None,
             ],
         )
         insert_source_result = cur.fetchone()
         assert insert_source_result is not None
         source_id: int = insert_source_result[0]
+        create_source_partitions(cur, type, source_id)
+        # before the commit, not to be seen abandoned
+        lock_source(cur, source_id)
+        db_conn.commit()
+    return source_id
+
+
+class SourceBusyError(Exception):
+    """Another process is processing the source"""
+
+
+def lock_source(cur: cursor, source_id: int) -> bool:
+    """Take the session lock that keeps two processes from processing the
+    same source, return whether it was free"""
+    cur.execute(
+        "select pg_try_advisory_lock('sources'::regclass::int, %s)", [source_id]
+    )
+    return cur.fetchone()[0]
+
+
+def unlock_source(cur: cursor, source_id: int):
+    cur.execute("select pg_advisory_unlock('sources'::regclass::int, %s)", [source_id])
+
+
+def release_source(db_conn: connection, source_id: int):
+    """Roll back and unlock the source, a lost connection already released
+    the lock"""
+    if db_conn.closed:
+        return
+    db_conn.rollback()
+    with db_conn.cursor() as cur:
+        unlock_source(cur, source_id)
         db_conn.commit()
 
+
+def update_source_progress(cur: cursor, source_id: int, processed_records: int):
+    """Count staged rows as processed, in the transaction that processes them"""
+    cur.execute(
+        "update sources set number_of_processed_records = number_of_processed_records + %s where id = %s",
+        [processed_records, source_id],
+    )
+
+
+def record_source_error(db_conn: connection, source_id: int, exc: Exception):
+    db_conn.rollback()
+    with db_conn.cursor() as cur:
+        cur.execute(
+            "insert into source_errors(source_id, errors) values(%s, %s)",
+            # simple error logging for now
+            [source_id, json.dumps({"message": repr(exc)})],
+        )
+        db_conn.commit()
+
+
+def import_csv(
+    db_conn: connection,
+    type: Type,
+    csv_fd: t.TextIO,
+    *,
+    delimiter: str = ",",
+    quotechar: t.Optional[str] = None,
+    filename: t.Optional[str] = None,
+    keep_lock: bool = False,
+):
+    """Stage the rows of the csv file into a new source, return its id. With
+    `keep_lock` the source stays locked once staged, for the caller to
+    process it before any worker, then to release it (see `release_source`)."""
+    if not quotechar:
+        quotechar = '"'
+    stats = PhaseStats("copy")
+    source_id = create_source(
+        db_conn, type, filename or os.path.basename(csv_fd.name)
+    )
+
     try:
         reader = csv.reader(csv_fd, delimiter=delimiter, quotechar=quotechar)
         # submitted_by_arr = next(reader)
@@ -51,9 +134,9 @@ def import_csv(
         sql_col_placeholders = ",".join(["{}" for _h in headers])
         sql_cols = [sql.Identifier(h.lower()) for h in headers]
         csv_table_name = DATA_MAPPING[type].csv_table
-        with db_conn.cursor() as cur:
+        with stats.cursor(db_conn) as cur:
             copy_sql = sql.SQL(
-                f"COPY {{}}({sql_col_placeholders}) FROM STDIN DELIMITER E{{}} CSV QUOTE {{}}"
+                f"COPY {{}}(source_id, processed_at, {sql_col_placeholders}) FROM STDIN DELIMITER E{{}} CSV QUOTE {{}}"
             ).format(
                 sql.Identifier(csv_table_name),
                 *sql_cols,
@@ -62,166 +145,484 @@ def import_csv(
             )
             cur.copy_expert(
                 copy_sql,
-                csv_fd,
-            )
-            set_source_id_sql = sql.SQL(
-                "update {} set source_id = %s where source_id is null"
-            ).format(
-                sql.Identifier(csv_table_name),
-            )
-            cur.execute(set_source_id_sql, [source_id])
-            set_processed_at_sql = sql.SQL(
-                "update {} set processed_at = 0 where source_id = %s"
-            ).format(
-                sql.Identifier(csv_table_name),
+                SourceStampedCsv(
+                    csv_fd, [source_id, 0], delimiter=delimiter, quotechar=quotechar
+                ),
             )
-            cur.execute(set_processed_at_sql, [source_id])
-            db_conn.commit()
-    except Exception as exc:
-        db_conn.rollback()
-        with db_conn.cursor() as cur:
+            stats.rows_in = stats.rows_out = cur.rowcount
             cur.execute(
-                "insert into source_errors(source_id, errors) values(%s, %s)",
-                # simple error logging for now
-                [source_id, json.dumps({"message": repr(exc)})],
+                "update sources set number_of_records = %s where id = %s",
+                [stats.rows_in, source_id],
             )
             db_conn.commit()
+    except Exception as exc:
+        record_source_error(db_conn, source_id, exc)
+        release_source(db_conn, source_id)
         raise exc
-    logger.info("Done import csv")
+    if not keep_lock:
+        release_source(db_conn, source_id)
+    stats.finish(db_conn, source_id)
     return source_id
 
 
-def process_csv_insert(db_conn: connection, source: Source):
+def get_database_error(exc: psycopg2.Error) -> str:
+    return json.dumps({"message": exc.diag.message_primary or str(exc)})
+
+
+def _write_isolating_errors(
+    cur: cursor, write: t.Callable[[cursor, list], list], records: list
+) -> tuple[list, list[tuple[int, psycopg2.Error]]]:
+    """Write `(csv row id, values)` records under a savepoint. When the
+    database rejects them, roll back and bisect down to the offending
+    records. Return what the writes returned and the csv row ids of the
+    rejected records with the errors."""
+    cur.execute("savepoint write_batch")
+    try:
+        written = write(cur, [values for _, values in records])
+    except (psycopg2.DataError, psycopg2.IntegrityError) as exc:
+        cur.execute("rollback to savepoint write_batch")
+        # the bisection opens savepoints of its own, don't nest them
+        cur.execute("release savepoint write_batch")
+        if len(records) == 1:
+            return [], [(records[0][0], exc)]
+        middle = len(records) // 2
+        written, failed = _write_isolating_errors(cur, write, records[:middle])
+        more_written, more_failed = _write_isolating_errors(
+            cur, write, records[middle:]
+        )
+        return written + more_written, failed + more_failed
+    cur.execute("release savepoint write_batch")
+    return written, []
+
+
+def upsert_batch(
+    cur: cursor,
+    upsert_statement: PreparedStatement,
+    records: list,
+    primary_key_index: int,
+    mode: ProcessMode = ProcessMode.BULK,
+) -> tuple[collections.Counter, list[tuple[int, psycopg2.Error]]]:
+    """Upsert `(csv row id, values)` records. Return the number of rows
+    inserted, updated and left unchanged, and the csv row ids of the records
+    the database rejected with the errors."""
+    counts: collections.Counter = collections.Counter()
+    if not records:
+        return counts, []
+    if mode is ProcessMode.BULK:
+        # a single statement can't touch the same key twice,
+        # so the last occurrence in the batch wins
+        records = list({v[primary_key_index]: (i, v) for i, v in records}.values())
+
+        def write(cur: cursor, insert_data: list) -> list:
+            # an array per field
+            upsert_statement.execute(cur, [list(c) for c in zip(*insert_data)])
+            return cur.fetchall()
+
+    else:
+
+        def write(cur: cursor, insert_data: list) -> list:
+            written = []
+            for values in insert_data:
+                upsert_statement.execute(cur, values)
+                written.extend(cur.fetchall())
+            return written
+
+    # lock the keys in the same order as any concurrent worker does
+    records.sort(key=lambda record: record[1][primary_key_index])
+    written, failed = _write_isolating_errors(cur, write, records)
+    counts["inserted"] = sum(1 for (inserted,) in written if inserted)
+    counts["updated"] = len(written) - counts["inserted"]
+    counts["unchanged"] = len(records) - len(failed) - len(written)
+    return counts, failed
+
+
+def get_staged_key_sql(type: Type) -> sql.Composable:
+    """The staged primary key as the table stores it, null when it can't be
+    cast, the row is then rejected by the validation anyway"""
+    primary_key = sql.Identifier(DATA_MAPPING[type].primary_key)
+    annotation = DATA_MAPPING[type].model.model_fields[
+        DATA_MAPPING[type].primary_key_field
+    ].annotation
+    if annotation is int:
+        return sql.SQL(
+            "case when {pk} ~ '^\\s*[+-]?\\d{{1,18}}\\s*$' then trim({pk})::bigint end"
+        ).format(pk=primary_key)
+    return primary_key
+
+
+def get_dedup_sql(type: Type) -> sql.Composed:
+    """Mark the staged rows superseded by a later version of their key as
+    processed. The latest `UpdatedDate` wins, then the latest staged row,
+    tombstones included. A row without a usable `UpdatedDate`, like most
+    tombstones, is as recent as the latest version staged before it, so it
+    only loses to rows staged after it. A tombstone left for a key that isn't
+    in the table only undoes versions of the same source, it's marked as
+    well."""
+    return sql.SQL(
+        """with staged as (
+            select id, lower(isdeleted) = 'true' as is_deleted, {key} as key,
+                -- ISO dates sort as text, other formats don't validate
+                case when updateddate ~ '^\\d{{4}}-\\d{{2}}-\\d{{2}}$' then updateddate end as updated
+            from {csv_table}
+            where source_id = %(source_id)s and processed_at = 0
+            and lower(isdeleted) in ('true', 'false')
+        ),
+        dated as (
+            select id, is_deleted, key,
+                coalesce(updated, max(updated) over (
+                    partition by key order by id rows between unbounded preceding and 1 preceding
+                )) as updated
+            from staged
+            where key is not null
+        ),
+        ranked as (
+            select id, is_deleted, key,
+                row_number() over (partition by key order by updated desc nulls last, id desc) as version,
+                count(*) filter (where not is_deleted) over (partition by key) as upserts
+            from dated
+        ),
+        superseded as (
+            update {csv_table} set processed_at = %(processed_at)s
+            from ranked
+            where {csv_table}.source_id = %(source_id)s
+            and {csv_table}.id = ranked.id
+            and (
+                ranked.version > 1
+                or (
+                    ranked.is_deleted
+                    and ranked.upserts > 0
+                    and not exists (select from {table} where {table}.{pk} = ranked.key)
+                )
+            )
+            returning 1
+        )
+        select (select count(*) from ranked), (select count(*) from superseded)"""
+    ).format(
+        key=get_staged_key_sql(type),
+        csv_table=sql.Identifier(DATA_MAPPING[type].csv_table),
+        table=sql.Identifier(DATA_MAPPING[type].table),
+        pk=sql.Identifier(DATA_MAPPING[type].primary_key),
+    )
+
+
+def dedup_source(db_conn: connection, source: Source):
+    """Keep a single version of each key of a source, so that each key is
+    written at most once however many times the file updates it"""
+    stats = PhaseStats("dedup")
+    with stats.cursor(db_conn) as cur:
+        cur.execute(
+            get_dedup_sql(source.type),
+            {"source_id": source.id, "processed_at": int(time.time())},
+        )
+        keyed, superseded = cur.fetchone()
+        stats.batches = 1
+        stats.rows_in = keyed
+        stats.rows_out = keyed - superseded
+        update_source_progress(cur, source.id, superseded)
+        db_conn.commit()
+    stats.finish(db_conn, source.id)
+
+
+def process_csv_insert(
+    db_conn: connection,
+    source: Source,
+    *,
+    mode: ProcessMode = ProcessMode.ROW,
+    id_range: t.Optional[tuple[int, int]] = None,
+):
     model = DATA_MAPPING[source.type].model
     csv_table_name = DATA_MAPPING[source.type].csv_table
+    primary_key = DATA_MAPPING[source.type].primary_key
 
     model_fields = list(model.model_fields.keys())
     fields = [f.lower() for f in model_fields]
-    fields_without_primary_key = fields[:]
-    fields_without_primary_key.remove(DATA_MAPPING[source.type].primary_key)
+    primary_key_index = fields.index(primary_key)
     csv_fields = [*fields, CSV_ID_FIELD]
     csv_fields_select = ", ".join(csv_fields)
     get_insert_sql = sql.SQL(
-        f"select {csv_fields_select} from {{}} where source_id = %s and LOWER(IsDeleted) = 'false' and processed_at = 0"
+        f"select {csv_fields_select} from {{}} where source_id = %s and LOWER(IsDeleted) = 'false' and processed_at = 0{_id_range_sql(id_range)}"
     ).format(sql.Identifier(csv_table_name))
-    with db_conn.cursor() as cur1, db_conn.cursor() as cur2:
-        cur1.execute(get_insert_sql, [source.id])
+    upsert_statement = get_upsert_statement(source.type, mode)
+    mark_processed_statement = get_mark_processed_statement(source.type)
+    validator = get_batch_validator(model)
+    stats = PhaseStats("insert")
+
+    with stats.cursor(db_conn) as cur1, stats.cursor(db_conn) as cur2:
+        error_sink = CsvErrorSink(cur2, source.id, csv_table_name)
+        cur1.execute(get_insert_sql, [source.id, *(id_range or ())])
         while True:
             insert_data = []
             csv_row_ids = []
             rows = cur1.fetchmany(1000)
             if not rows:
                 break
+            batch = []
             for row in rows:
                 csv_row_ids.append(row[len(csv_fields) - 1])
-                fields_values = {f: row[i] for (i, f) in enumerate(model_fields)}
-                try:
-                    _ = model(**fields_values)
+                batch.append({f: row[i] for (i, f) in enumerate(model_fields)})
+            validation_start = time.perf_counter()
+            results = validator.validate(batch)
+            stats.validation_time += time.perf_counter() - validation_start
+            for row_id, result in zip(csv_row_ids, results):
+                if isinstance(result, ValidationError):
+                    error_sink.add(row_id, result.json())
+                else:
                     # TODO: check if ExternalIdentifier exists
-                    insert_data.append(list(fields_values.values()))
-                except ValidationError as err:
-                    cur2.execute(
-                        sql.SQL(
-                            "update {} set processed_at = %s, errors = %s where id = %s"
-                        ).format(sql.Identifier(csv_table_name)),
-                        [int(time.time()), err.json(), row[len(csv_fields) - 1]],
-                    )
-                    cur2.execute(
-                        "insert into csv_errors(source_id, record_id, errors) values(%s, %s, %s)",
-                        [
-                            source.id,
-                            row[len(csv_fields) - 1],
-                            err.json(),
-                        ],
-                    )
-
-            values_placeholder = ", ".join(["%s"] * len(fields))
-            set_on_conflict_sql = ", ".join(["{} = EXCLUDED.{}" for _ in fields_without_primary_key])
-
-            cur2.executemany(
-                sql.SQL(
-                    f"insert into {{}}({', '.join(fields)}) values({values_placeholder}) on conflict ({{}}) do update set {set_on_conflict_sql}"
-                ).format(
-                    sql.Identifier(DATA_MAPPING[source.type].table),
-                    sql.Identifier(DATA_MAPPING[source.type].primary_key),
-                    *(
-                        sql.Identifier(f)
-                        for f in itertools.chain.from_iterable(
-                            (f, f) for f in fields_without_primary_key
-                        )
-                    ),
-                ),
-                insert_data,
+                    insert_data.append((row_id, validator.values(result)))
+
+            counts, failed = upsert_batch(
+                cur2, upsert_statement, insert_data, primary_key_index, mode
             )
-            cur2.execute(
-                sql.SQL("update {} set processed_at = %s where id in %s").format(
-                    sql.Identifier(csv_table_name)
-                ),
-                [int(time.time()), tuple(csv_row_ids)],
+            for row_id, exc in failed:
+                error_sink.add(row_id, get_database_error(exc))
+            stats.add_upserts(counts)
+            stats.batches += 1
+            stats.rows_in += len(rows)
+            stats.rows_out += len(insert_data) - len(failed)
+            stats.rows_rejected += len(error_sink)
+            error_sink.flush()
+            mark_processed_statement.execute(
+                cur2, [int(time.time()), source.id, csv_row_ids]
             )
+            update_source_progress(cur2, source.id, len(rows))
             db_conn.commit()
-    logger.info("Done process insert csv")
+    stats.finish(db_conn, source.id)
+
+
+def get_primary_key_adapter(type: Type) -> TypeAdapter:
+    # staged keys are varchar, coerce them to what the table stores
+    return TypeAdapter(
+        DATA_MAPPING[type].model.model_fields[DATA_MAPPING[type].primary_key_field].annotation
+    )
+
+
+def delete_batch(
+    cur: cursor,
+    delete_statement: PreparedStatement,
+    key_adapter: TypeAdapter,
+    rows: list,
+) -> tuple[list[int], list[int]]:
+    """Delete the keys of a batch at once, return the deleted and the missing
+    csv row ids."""
+    record_ids_by_key = collections.defaultdict(list)
+    missing_record_ids = []
+    for key, record_id in rows:
+        try:
+            record_ids_by_key[key_adapter.validate_python(key)].append(record_id)
+        except ValidationError:
+            # can't be stored in the table in the first place
+            missing_record_ids.append(record_id)
+    if not record_ids_by_key:
+        return [], missing_record_ids
 
+    # lock the keys in the same order as any concurrent worker does
+    delete_statement.execute(cur, [sorted(record_ids_by_key)])
+    deleted_keys = {row[0] for row in cur.fetchall()}
+    deleted_record_ids = []
+    for key, record_ids in record_ids_by_key.items():
+        if key in deleted_keys:
+            deleted_record_ids.extend(record_ids)
+        else:
+            missing_record_ids.extend(record_ids)
+    return deleted_record_ids, missing_record_ids
 
-def process_csv_delete(db_conn: connection, source: Source):
-    table = DATA_MAPPING[source.type].table
+
+def get_missing_key_error(type: Type) -> str:
+    return json.dumps(
+        {"message": f"{DATA_MAPPING[type].primary_key_field} does not exist"}
+    )
+
+
+def process_csv_delete(
+    db_conn: connection,
+    source: Source,
+    *,
+    mode: ProcessMode = ProcessMode.ROW,
+    id_range: t.Optional[tuple[int, int]] = None,
+):
     csv_table_name = DATA_MAPPING[source.type].csv_table
     fields = [DATA_MAPPING[source.type].primary_key, CSV_ID_FIELD]
     fields_select = ", ".join(fields)
     get_insert_sql = sql.SQL(
-        f"select {fields_select} from {{}} where source_id = %s and LOWER(IsDeleted) = 'true' and processed_at = 0"
+        f"select {fields_select} from {{}} where source_id = %s and LOWER(IsDeleted) = 'true' and processed_at = 0{_id_range_sql(id_range)}"
     ).format(sql.Identifier(csv_table_name))
-    with db_conn.cursor() as cur1, db_conn.cursor() as cur2:
-        cur1.execute(get_insert_sql, [source.id])
+    delete_statement = get_delete_statement(source.type, mode)
+    mark_processed_statement = get_mark_processed_statement(source.type)
+    if mode is ProcessMode.BULK:
+        key_adapter = get_primary_key_adapter(source.type)
+    missing_error = get_missing_key_error(source.type)
+    stats = PhaseStats("delete")
+    with stats.cursor(db_conn) as cur1, stats.cursor(db_conn) as cur2:
+        error_sink = CsvErrorSink(cur2, source.id, csv_table_name)
+        cur1.execute(get_insert_sql, [source.id, *(id_range or ())])
         while True:
             csv_row_ids: list[int] = []
             rows = cur1.fetchmany(1000)
             if not rows:
                 break
-            for row in rows:
-                cur2.execute(
-                    sql.SQL("delete from {} where {}=%s").format(
-                        sql.Identifier(table), sql.Identifier(fields[0])
-                    ),
-                    [
-                        row[0],
-                    ],
+            if mode is ProcessMode.BULK:
+                csv_row_ids, missing_row_ids = delete_batch(
+                    cur2, delete_statement, key_adapter, rows
                 )
-                if cur2.rowcount != 0:
-                    csv_row_ids.append(row[1])
-                else:
-                    cur2.execute(
-                        sql.SQL("update {} set processed_at = %s where id = %s").format(sql.Identifier(csv_table_name)),
-                        [
-                            int(time.time()),
-                            row[1],
-                        ],
-                    )
-                    cur2.execute(
-                        "insert into csv_errors(source_id, record_id, errors) values(%s, %s, %s)",
-                        [
-                            source.id,
-                            row[1],
-                            json.dumps(
-                                {"message": "ExternalIdentifier does not exist"}
-                            ),
-                        ],
-                    )
+                for row_id in missing_row_ids:
+                    error_sink.add(row_id, missing_error)
+            else:
+                for row in rows:
+                    delete_statement.execute(cur2, [row[0]])
+                    if cur2.rowcount != 0:
+                        csv_row_ids.append(row[1])
+                    else:
+                        error_sink.add(row[1], missing_error)
+            stats.batches += 1
+            stats.rows_in += len(rows)
+            stats.rows_out += len(csv_row_ids)
+            stats.rows_rejected += len(error_sink)
+            error_sink.flush()
             if csv_row_ids:
-                cur2.execute(
-                    "update area_csv set processed_at = %s where id in %s",
-                    [int(time.time()), tuple(csv_row_ids)],
+                mark_processed_statement.execute(
+                    cur2, [int(time.time()), source.id, csv_row_ids]
+                )
+            update_source_progress(cur2, source.id, len(rows))
+            db_conn.commit()
+    stats.finish(db_conn, source.id)
+
+
+def _id_range_sql(id_range: t.Optional[tuple[int, int]]) -> str:
+    return " and id between %s and %s" if id_range else ""
+
+
+def get_pending_id_ranges(
+    db_conn: connection, source: Source, parts: int
+) -> list[tuple[int, int]]:
+    """Split the ids of the staged rows still to process into `parts` ranges"""
+    with db_conn.cursor() as cur:
+        cur.execute(
+            sql.SQL(
+                "select min(id), max(id) from {} where source_id = %s and processed_at = 0"
+            ).format(sql.Identifier(DATA_MAPPING[source.type].csv_table)),
+            [source.id],
+        )
+        min_id, max_id = cur.fetchone()
+        db_conn.commit()
+    if min_id is None:
+        return []
+    step = (max_id - min_id) // parts + 1
+    return [
+        (start, min(start + step - 1, max_id))
+        for start in range(min_id, max_id + 1, step)
+    ]
+
+
+def _process_csv_range(
+    config: AppConfiguration,
+    source: Source,
+    process: t.Callable,
+    mode: ProcessMode,
+    id_range: tuple[int, int],
+):
+    db_conn = get_db_conn(config)
+    try:
+        process(db_conn, source, mode=mode, id_range=id_range)
+    finally:
+        db_conn.close()
+
+
+def process_csv_parallel(
+    config: AppConfiguration,
+    source: Source,
+    id_ranges: list[tuple[int, int]],
+    *,
+    mode: ProcessMode = ProcessMode.ROW,
+    workers: int,
+):
+    """Process the id ranges of a source in a pool of processes, each with
+    its own connection. All inserts finish before any delete starts, same as
+    the sequential order."""
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for process in (process_csv_insert, process_csv_delete):
+            list(
+                executor.map(
+                    partial(_process_csv_range, config, source, process, mode),
+                    id_ranges,
                 )
+            )
+
+
+def process_csv(
+    db_conn: connection,
+    source: Source,
+    *,
+    mode: ProcessMode = ProcessMode.ROW,
+    workers: int = 1,
+    config: t.Optional[AppConfiguration] = None,
+):
+    """Process the staged rows of a source that are still pending. Every
+    batch is committed with its progress, so after an interruption calling
+    this again carries on from the last committed batch."""
+    with db_conn.cursor() as cur:
+        if not lock_source(cur, source.id):
+            db_conn.rollback()
+            raise SourceBusyError(f"source {source.id} is being processed")
+        cur.execute(
+            "update sources set processing_started_at = now(), processed_at = null, stats = stats - 'dedup' - 'insert' - 'delete' where id=%s",
+            [source.id],
+        )
+        db_conn.commit()
+    try:
+        dedup_source(db_conn, source)
+        if workers > 1:
+            assert config is not None, "workers need the config to connect"
+            id_ranges = get_pending_id_ranges(db_conn, source, workers)
+            process_csv_parallel(config, source, id_ranges, mode=mode, workers=workers)
+        else:
+            process_csv_insert(db_conn, source, mode=mode)
+            process_csv_delete(db_conn, source, mode=mode)
+        with db_conn.cursor() as cur:
+            cur.execute("update sources set processed_at = now() where id=%s", [source.id])
+            update_source_errors_count(cur, source.id)
+            notify_source_processed(cur, source.id)
             db_conn.commit()
-    logger.info("Done process delete csv")
+    finally:
+        release_source(db_conn, source.id)
 
 
-def process_csv(db_conn: connection, source: Source):
+def get_pending_sources(db_conn: connection) -> list[int]:
+    """The ids of the staged sources whose processing didn't finish"""
+    with db_conn.cursor() as cur:
+        cur.execute(
+            """select id from sources
+            where processed_at is null
+            and number_of_records > 0
+            and not exists (select from source_errors where source_id = sources.id)
+            order by id"""
+        )
+        source_ids = [row[0] for row in cur.fetchall()]
+        db_conn.commit()
+    return source_ids
+
+
+def resume_source(
+    db_conn: connection,
+    source_id: int,
+    *,
+    mode: ProcessMode = ProcessMode.ROW,
+    workers: int = 1,
+    config: t.Optional[AppConfiguration] = None,
+):
+    """Process what is left of a source, see `process_csv`"""
     with db_conn.cursor() as cur:
-        cur.execute("update sources set processed_at = now() where id=%s", [source.id])
+        cur.execute(
+            "select type, number_of_records from sources where id = %s", [source_id]
+        )
+        row = cur.fetchone()
         db_conn.commit()
-    process_csv_insert(db_conn, source)
-    process_csv_delete(db_conn, source)
+    if row is None:
+        raise ValueError(f"source {source_id} does not exist")
+    if not row[1]:
+        # the rest of a streamed file was never staged
+        raise ValueError(f"source {source_id} wasn't fully staged, import its file again")
+    source = Source(id=source_id, type=Type(row[0]))
+    process_csv(db_conn, source, mode=mode, workers=workers, config=config)
 
 
 def import_and_process_csv(
@@ -231,9 +632,37 @@ def import_and_process_csv(
     csv_fo: t.TextIO,
     delimiter: str = ",",
     quotechar: str = '"',
+    mode: ProcessMode = ProcessMode.ROW,
+    workers: int = 1,
+    config: t.Optional[AppConfiguration] = None,
+    stream: bool = False,
+    filename: t.Optional[str] = None,
 ):
+    if stream:
+        from idfp.importers.stream import stream_csv
+
+        return stream_csv(
+            db_conn,
+            type,
+            csv_fo,
+            delimiter=delimiter,
+            quotechar=quotechar,
+            filename=filename,
+        )
+
     source_id = import_csv(
-        db_conn, type, csv_fo, delimiter=delimiter, quotechar=quotechar
+        db_conn,
+        type,
+        csv_fo,
+        delimiter=delimiter,
+        quotechar=quotechar,
+        filename=filename,
+        # otherwise `process-pending` or a worker could claim it first
+        keep_lock=True,
     )
     source = Source(id=source_id, type=type)
-    process_csv(db_conn, source)
+    try:
+        process_csv(db_conn, source, mode=mode, workers=workers, config=config)
+    finally:
+        release_source(db_conn, source_id)
+    return source_id
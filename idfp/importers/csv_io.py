@@ -0,0 +1,173 @@
+import bz2
+import gzip
+import io
+import lzma
+import os
+import typing as t
+
+
+class SourceStampedCsv:
+    """Read-only file-like object prefixing every csv record of `csv_fd` with
+    the given values, so that COPY can load them along with the record.
+
+    A record spans several lines when a quoted field contains a newline. With
+    the csv format of COPY an embedded quote is doubled, so a line starts a new
+    record exactly when the quotes read so far are balanced.
+    """
+
+    def __init__(
+        self,
+        csv_fd: t.TextIO,
+        values: list[t.Any],
+        *,
+        delimiter: str = ",",
+        quotechar: str = '"',
+    ):
+        self.csv_fd = csv_fd
+        self.prefix = "".join(f"{v}{delimiter}" for v in values)
+        self.quotechar = quotechar
+        self.in_quotes = False
+        self.pending = ""
+
+    def readline(self) -> str:
+        line = self.csv_fd.readline()
+        if not line:
+            return ""
+        stamped = line if self.in_quotes else self.prefix + line
+        if line.count(self.quotechar) % 2:
+            self.in_quotes = not self.in_quotes
+        return stamped
+
+    def read(self, size: int = -1) -> str:
+        chunks = [self.pending]
+        length = len(self.pending)
+        while size < 0 or length < size:
+            line = self.readline()
+            if not line:
+                break
+            chunks.append(line)
+            length += len(line)
+        data = "".join(chunks)
+        if size < 0:
+            self.pending = ""
+            return data
+        self.pending = data[size:]
+        return data[:size]
+
+
+class FileRange(io.RawIOBase):
+    """Read-only view of the bytes of a file between `start` and `end`"""
+
+    def __init__(self, path: str, start: int, end: int):
+        self.file = open(path, "rb")
+        self.file.seek(start)
+        self.remaining = end - start
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        if self.remaining <= 0:
+            return 0
+        size = self.file.readinto(memoryview(buffer)[: self.remaining])
+        self.remaining -= size
+        return size
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+def _skip_to_record_start(fd: t.BinaryIO, quotechar: bytes, in_quotes: bool) -> bool:
+    """Read `fd` up to the start of the next record given whether the
+    position is within quotes, return whether the end of the file was hit"""
+    while True:
+        line = fd.readline()
+        if not line:
+            return True
+        if line.count(quotechar) % 2:
+            in_quotes = not in_quotes
+        if not in_quotes:
+            return False
+
+
+def split_csv(
+    path: str, *, quotechar: str = '"', chunk_bytes: int = 64 * 1024 * 1024
+) -> tuple[int, list[tuple[int, int]]]:
+    """Split a csv file into byte ranges of whole records of about
+    `chunk_bytes`. Return the end of the header and the ranges of the data.
+
+    Quotes are counted from the start of the file, as in `SourceStampedCsv`,
+    which takes a single pass over the bytes without parsing them.
+    """
+    quote = quotechar.encode()
+    ranges = []
+    with open(path, "rb") as fd:
+        _skip_to_record_start(fd, quote, False)
+        header_end = start = fd.tell()
+        size = os.fstat(fd.fileno()).st_size
+        while start < size:
+            target = start + chunk_bytes
+            if target >= size:
+                ranges.append((start, size))
+                break
+            # the parity of the quotes of the range tells where the target is
+            quotes = 0
+            while fd.tell() < target:
+                block = fd.read(min(1024 * 1024, target - fd.tell()))
+                if not block:
+                    break
+                quotes += block.count(quote)
+            _skip_to_record_start(fd, quote, bool(quotes % 2))
+            ranges.append((start, fd.tell()))
+            start = fd.tell()
+    return header_end, ranges
+
+
+# magic bytes of the compressed files and the usual suffix of their names
+COMPRESSIONS = {
+    "gzip": (b"\x1f\x8b", ".gz"),
+    "bz2": (b"BZh", ".bz2"),
+    "xz": (b"\xfd7zXZ\x00", ".xz"),
+    "zstd": (b"\x28\xb5\x2f\xfd", ".zst"),
+}
+
+
+def detect_compression(fo: io.BufferedReader) -> t.Optional[str]:
+    """The compression of a file from its first bytes, without consuming them"""
+    head = fo.peek(6)[:6]
+    for compression, (magic, _) in COMPRESSIONS.items():
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def open_csv(fo: t.BinaryIO, *, encoding: str = "utf-8") -> t.TextIO:
+    """Text stream of a csv file, decompressed on the fly when compressed.
+    Only a buffer of the decompressed data is held at a time."""
+    if not hasattr(fo, "peek"):
+        fo = io.BufferedReader(fo)
+    compression = detect_compression(fo)
+    if compression == "gzip":
+        fo = gzip.GzipFile(fileobj=fo, mode="rb")
+    elif compression == "bz2":
+        fo = bz2.BZ2File(fo)
+    elif compression == "xz":
+        fo = lzma.LZMAFile(fo)
+    elif compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("reading zstd compressed files requires zstandard")
+        fo = io.BufferedReader(
+            zstandard.ZstdDecompressor().stream_reader(fo, read_across_frames=True)
+        )
+    return io.TextIOWrapper(fo, encoding=encoding, newline="")
+
+
+def csv_filename(filename: str) -> str:
+    """`filename` without the suffix of a compression"""
+    for _, suffix in COMPRESSIONS.values():
+        if filename.endswith(suffix):
+            return filename[: -len(suffix)]
+    return filename
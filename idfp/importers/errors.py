@@ -0,0 +1,63 @@
+import time
+
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+from psycopg2._psycopg import cursor
+
+
+class CsvErrorSink:
+    """Collect rejected csv rows and write them out in bulk.
+
+    Call `flush` once per batch, before committing, so that the errors land
+    in the same transaction as the rows that were accepted.
+    """
+
+    def __init__(
+        self, cur: cursor, source_id: int, csv_table: str, *, mark_staging: bool = True
+    ):
+        self.cur = cur
+        self.source_id = source_id
+        self.csv_table = csv_table
+        # off when the staged rows are written with their errors already
+        self.mark_staging = mark_staging
+        self.errors: list[tuple[int, str]] = []
+
+    def __len__(self):
+        return len(self.errors)
+
+    def add(self, record_id: int, errors: str):
+        self.errors.append((record_id, errors))
+
+    def flush(self):
+        if not self.errors:
+            return
+        if self.mark_staging:
+            self._mark_staging()
+        execute_values(
+            self.cur,
+            "insert into csv_errors(source_id, record_id, errors) values %s",
+            [(self.source_id, record_id, errors) for record_id, errors in self.errors],
+            page_size=len(self.errors),
+        )
+        self.errors = []
+
+    def _mark_staging(self):
+        processed_at = int(time.time())
+        execute_values(
+            self.cur,
+            sql.SQL(
+                "update {} as t set processed_at = data.processed_at, errors = data.errors"
+                " from (values %s) as data(id, processed_at, errors)"
+                " where t.source_id = {} and t.id = data.id"
+            ).format(sql.Identifier(self.csv_table), sql.Literal(self.source_id)),
+            [(record_id, processed_at, errors) for record_id, errors in self.errors],
+            template="(%s, %s, %s::json)",
+            page_size=len(self.errors),
+        )
+
+
+def update_source_errors_count(cur: cursor, source_id: int):
+    cur.execute(
+        "update sources set csv_errors_count = (select count(*) from csv_errors where source_id = %s) where id = %s",
+        [source_id, source_id],
+    )
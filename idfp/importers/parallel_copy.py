@@ -0,0 +1,206 @@
+"""Stage many csv files, or big ones, into a single source with concurrent
+COPYs, each over a connection of its own.
+
+Files are split at record boundaries (see `split_csv`) and every chunk is
+copied by a process of a pool. Compressed files can't be split, each is
+copied whole by a single process. The source only gets its number of records
+once every chunk is staged, like a streamed import, so a partly staged source
+is never processed (see `resume_source`).
+"""
+import csv
+import glob
+import io
+import logging
+import os
+import time
+import typing as t
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from psycopg2 import sql
+from psycopg2._psycopg import connection
+
+from idfp.config import AppConfiguration
+from idfp.db import get_db_conn
+from idfp.definitions import DATA_MAPPING, ProcessMode, Source, Type
+from idfp.importers.base import (
+    create_source,
+    process_csv,
+    record_source_error,
+    release_source,
+)
+from idfp.importers.csv_io import (
+    FileRange,
+    SourceStampedCsv,
+    csv_filename,
+    detect_compression,
+    open_csv,
+    split_csv,
+)
+from idfp.importers.stats import PhaseStats
+
+logger = logging.getLogger(__name__)
+
+
+def expand_paths(pattern: str) -> list[str]:
+    """The files of a directory, of a glob pattern or the file itself"""
+    if os.path.isdir(pattern):
+        paths = [
+            entry.path
+            for entry in os.scandir(pattern)
+            if entry.is_file() and not entry.name.startswith(".")
+        ]
+    else:
+        paths = [p for p in glob.glob(pattern) if os.path.isfile(p)]
+    return sorted(paths)
+
+
+def _read_header(path: str, delimiter: str, quotechar: str) -> list[str]:
+    with open(path, "rb") as fd, open_csv(fd) as csv_fd:
+        return next(csv.reader(csv_fd, delimiter=delimiter, quotechar=quotechar))
+
+
+def _open_chunk(
+    path: str, start: int, end: t.Optional[int], delimiter: str, quotechar: str
+) -> t.TextIO:
+    if end is not None:
+        return io.TextIOWrapper(
+            io.BufferedReader(FileRange(path, start, end)), encoding="utf-8", newline=""
+        )
+    # a compressed file, whole and past its header
+    csv_fd = open_csv(open(path, "rb"))
+    next(csv.reader(csv_fd, delimiter=delimiter, quotechar=quotechar))
+    return csv_fd
+
+
+def _copy_chunk(
+    config: AppConfiguration,
+    type: Type,
+    source_id: int,
+    delimiter: str,
+    quotechar: str,
+    chunk: tuple[str, list[str], int, t.Optional[int]],
+) -> tuple[int, float]:
+    """COPY a byte range of a file, or a whole compressed file, return the rows
+    copied and the seconds"""
+    path, headers, start, end = chunk
+    copy_sql = sql.SQL(
+        "COPY {}(source_id, processed_at, {}) FROM STDIN DELIMITER E{} CSV QUOTE {}"
+    ).format(
+        sql.Identifier(DATA_MAPPING[type].csv_table),
+        sql.SQL(", ").join(sql.Identifier(h.lower()) for h in headers),
+        sql.Literal(delimiter),
+        sql.Literal(quotechar),
+    )
+    started_at = time.perf_counter()
+    db_conn = get_db_conn(config)
+    try:
+        with _open_chunk(path, start, end, delimiter, quotechar) as csv_fd:
+            with db_conn.cursor() as cur:
+                cur.copy_expert(
+                    copy_sql,
+                    SourceStampedCsv(
+                        csv_fd, [source_id, 0], delimiter=delimiter, quotechar=quotechar
+                    ),
+                )
+                rowcount = cur.rowcount
+            db_conn.commit()
+    finally:
+        db_conn.close()
+    return rowcount, time.perf_counter() - started_at
+
+
+def import_csv_parallel(
+    db_conn: connection,
+    config: AppConfiguration,
+    type: Type,
+    paths: list[str],
+    *,
+    delimiter: str = ",",
+    quotechar: t.Optional[str] = None,
+    copy_workers: int = 4,
+    chunk_bytes: int = 64 * 1024 * 1024,
+    filename: t.Optional[str] = None,
+    keep_lock: bool = False,
+) -> int:
+    if not quotechar:
+        quotechar = '"'
+    stats = PhaseStats("copy")
+    source_id = create_source(
+        db_conn, type, filename or ", ".join(os.path.basename(p) for p in paths)
+    )
+    try:
+        chunks = []
+        for path in paths:
+            headers = _read_header(path, delimiter, quotechar)
+            with open(path, "rb") as fd:
+                compression = detect_compression(fd)
+            if compression:
+                chunks.append((path, headers, 0, None))
+                continue
+            _, ranges = split_csv(path, quotechar=quotechar, chunk_bytes=chunk_bytes)
+            chunks.extend((path, headers, start, end) for start, end in ranges)
+        with ProcessPoolExecutor(max_workers=copy_workers) as executor:
+            for rowcount, seconds in executor.map(
+                partial(_copy_chunk, config, type, source_id, delimiter, quotechar),
+                chunks,
+            ):
+                stats.rows_in += rowcount
+                stats.sql_time += seconds
+                stats.round_trips += 1
+                stats.batches += 1
+        stats.rows_out = stats.rows_in
+        with db_conn.cursor() as cur:
+            cur.execute(
+                "update sources set number_of_records = %s where id = %s",
+                [stats.rows_in, source_id],
+            )
+            db_conn.commit()
+    except Exception as exc:
+        record_source_error(db_conn, source_id, exc)
+        release_source(db_conn, source_id)
+        raise exc
+    if not keep_lock:
+        release_source(db_conn, source_id)
+    stats.finish(db_conn, source_id)
+    return source_id
+
+
+def import_and_process_paths(
+    *,
+    db_conn: connection,
+    config: AppConfiguration,
+    type: Type,
+    pattern: str,
+    delimiter: str = ",",
+    quotechar: str = '"',
+    mode: ProcessMode = ProcessMode.ROW,
+    workers: int = 1,
+    copy_workers: int = 4,
+):
+    paths = expand_paths(pattern)
+    if not paths:
+        raise ValueError(f"no file matches {pattern}")
+    source_id = import_csv_parallel(
+        db_conn,
+        config,
+        type,
+        paths,
+        delimiter=delimiter,
+        quotechar=quotechar,
+        copy_workers=copy_workers,
+        filename=(
+            os.path.basename(pattern.rstrip(os.sep))
+            if len(paths) > 1
+            else csv_filename(os.path.basename(paths[0]))
+        ),
+        # see `import_and_process_csv`
+        keep_lock=True,
+    )
+    try:
+        process_csv(
+            db_conn, Source(id=source_id, type=type), mode=mode, workers=workers, config=config
+        )
+    finally:
+        release_source(db_conn, source_id)
+    return source_id
@@ -0,0 +1,175 @@
+"""Queue of the staged sources waiting to be processed, kept on `sources`.
+
+Workers on any machine claim queued sources with `for update skip locked` and
+hold the source lock while processing them (see `lock_source`). The lock goes
+away with the session of a dead worker, whose source is then claimed again
+and carries on from its last committed batch.
+"""
+import json
+import logging
+import multiprocessing
+import select
+import signal
+import typing as t
+
+import psycopg2
+from psycopg2._psycopg import connection, cursor
+
+from idfp.config import AppConfiguration
+from idfp.db import SOURCE_QUEUED_CHANNEL, get_db_conn, notify_source_queued
+from idfp.definitions import ProcessMode, Source, Type
+from idfp.importers.base import (
+    lock_source,
+    process_csv,
+    record_source_error,
+    release_source,
+    unlock_source,
+)
+
+logger = logging.getLogger(__name__)
+
+# queued sources looked at by a claim, those being processed come last
+CLAIM_CANDIDATES = 10
+
+
+def enqueue_source(cur: cursor, source_id: int):
+    cur.execute("update sources set queued_at = now() where id = %s", [source_id])
+    notify_source_queued(cur, source_id)
+
+
+def claim_source(db_conn: connection) -> t.Optional[Source]:
+    """Lock the oldest queued source that no worker is processing. The lock is
+    held until `unlock_source`, across transactions."""
+    with db_conn.cursor() as cur:
+        cur.execute(
+            """select id, type from sources
+            where queued_at is not null
+            and processed_at is null
+            and not exists (select from source_errors where source_id = sources.id)
+            order by processing_started_at nulls first, id
+            limit %s
+            for update skip locked""",
+            [CLAIM_CANDIDATES],
+        )
+        for source_id, type in cur.fetchall():
+            if lock_source(cur, source_id):
+                db_conn.commit()
+                return Source(id=source_id, type=Type(type))
+        db_conn.commit()
+    return None
+
+
+def fail_abandoned_sources(db_conn: connection) -> list[int]:
+    """Record an error for the sources whose staging was interrupted, e.g. by
+    the timeout of the web worker of their upload, return their ids. They
+    have no number_of_records and nobody holds their lock (see
+    `create_source`)."""
+    failed = []
+    with db_conn.cursor() as cur:
+        cur.execute(
+            """select id from sources
+            where number_of_records is null
+            and processed_at is null
+            and not exists (select from source_errors where source_id = sources.id)
+            order by id"""
+        )
+        for (source_id,) in cur.fetchall():
+            if not lock_source(cur, source_id):
+                continue
+            cur.execute(
+                "insert into source_errors(source_id, errors) values(%s, %s)",
+                [
+                    source_id,
+                    json.dumps({"message": "the file wasn't fully staged, import it again"}),
+                ],
+            )
+            db_conn.commit()
+            unlock_source(cur, source_id)
+            failed.append(source_id)
+        db_conn.commit()
+    return failed
+
+
+def _wait_for_sources(db_conn: connection, timeout: float):
+    if not db_conn.notifies:
+        select.select([db_conn], [], [], timeout)
+        db_conn.poll()
+    db_conn.notifies.clear()
+
+
+def run_worker(
+    config: AppConfiguration,
+    stop: t.Any,
+    *,
+    mode: ProcessMode = ProcessMode.ROW,
+    poll_interval: float = 5.0,
+):
+    """Process queued sources one after the other until `stop` is set"""
+    # the parent process tells when to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    db_conn = None
+    while not stop.is_set():
+        try:
+            if db_conn is None or db_conn.closed:
+                db_conn = get_db_conn(config)
+                with db_conn.cursor() as cur:
+                    cur.execute(f"listen {SOURCE_QUEUED_CHANNEL}")
+                db_conn.commit()
+            db_conn.notifies.clear()
+            source = claim_source(db_conn)
+            if source is None:
+                for source_id in fail_abandoned_sources(db_conn):
+                    logger.warning(f"Source {source_id} wasn't fully staged")
+                _wait_for_sources(db_conn, poll_interval)
+                continue
+            logger.info(f"Processing source {source.id}")
+            try:
+                process_csv(db_conn, source, mode=mode)
+            except psycopg2.OperationalError:
+                # the database is gone, the source stays queued
+                raise
+            except Exception as exc:
+                logger.exception(f"Failed to process source {source.id}")
+                record_source_error(db_conn, source.id, exc)
+            finally:
+                release_source(db_conn, source.id)
+        except psycopg2.OperationalError:
+            logger.exception("Lost the database connection")
+            if db_conn is not None:
+                db_conn.close()
+            db_conn = None
+            stop.wait(poll_interval)
+    if db_conn is not None:
+        db_conn.close()
+
+
+def run_workers(
+    config: AppConfiguration,
+    *,
+    concurrency: int = 1,
+    mode: ProcessMode = ProcessMode.ROW,
+    poll_interval: float = 5.0,
+):
+    """Run `concurrency` worker processes until SIGINT or SIGTERM, a worker
+    stops once done with its current source"""
+    stop = multiprocessing.Event()
+    processes = [
+        multiprocessing.Process(
+            target=run_worker,
+            args=(config, stop),
+            kwargs={"mode": mode, "poll_interval": poll_interval},
+        )
+        for _ in range(concurrency)
+    ]
+
+    def request_stop(signum, frame):
+        logger.info("Stopping the workers")
+        stop.set()
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
@@ -0,0 +1,155 @@
+"""Server-side prepared statements of the importers.
+
+The statements of each type are built once from `DATA_MAPPING` and prepared
+on a connection the first time they run on it, each batch then only sends an
+`execute` with its parameters and reuses the plan of the server. Prepared
+statements outlive transactions but not sessions, the names prepared on a
+connection are forgotten with it.
+"""
+import dataclasses
+import enum
+import functools
+import typing as t
+import weakref
+from datetime import date
+
+from psycopg2 import sql
+from psycopg2._psycopg import connection, cursor
+
+from idfp.definitions import DATA_MAPPING, ProcessMode, Type
+
+# the `execute` of each statement prepared on a connection, by name
+_prepared: "weakref.WeakKeyDictionary[connection, dict[str, str]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+_PG_TYPES = {str: "varchar", int: "bigint", date: "date", bool: "boolean"}
+
+
+def get_pg_type(annotation: t.Any) -> str:
+    """The type of the parameters bound to a model field"""
+    args = [a for a in t.get_args(annotation) if a is not type(None)]
+    if t.get_origin(annotation) is t.Union and len(args) == 1:
+        annotation = args[0]
+    if isinstance(annotation, type) and issubclass(annotation, enum.Enum):
+        # validated values are written as the values of their members
+        annotation = type(next(iter(annotation)).value)
+    try:
+        return _PG_TYPES[annotation]
+    except KeyError:
+        raise TypeError(f"no parameter type for {annotation!r}")
+
+
+@dataclasses.dataclass
+class PreparedStatement:
+    name: str
+    statement: sql.Composable
+    types: list[str]
+    execute_sql: sql.Composed = dataclasses.field(init=False)
+
+    def __post_init__(self):
+        # the parameters are sent as literals, cast them like `prepare` does
+        self.execute_sql = sql.SQL("execute {}({})").format(
+            sql.Identifier(self.name),
+            sql.SQL(", ").join(sql.SQL(f"%s::{pg_type}") for pg_type in self.types),
+        )
+
+    def prepare(self, cur: cursor) -> str:
+        """Prepare the statement on the connection of `cur` unless it already
+        is, return its `execute` with the placeholders of the parameters"""
+        prepared = _prepared.setdefault(cur.connection, {})
+        if self.name in prepared:
+            return prepared[self.name]
+        cur.execute(
+            sql.SQL("prepare {}({}) as {}").format(
+                sql.Identifier(self.name),
+                sql.SQL(", ").join(sql.SQL(pg_type) for pg_type in self.types),
+                self.statement,
+            )
+        )
+        prepared[self.name] = self.execute_sql.as_string(cur)
+        return prepared[self.name]
+
+    def execute(self, cur: cursor, params: t.Sequence):
+        cur.execute(self.prepare(cur), params)
+
+
+def _placeholders(count: int) -> sql.Composable:
+    return sql.SQL(", ").join(sql.SQL(f"${i}") for i in range(1, count + 1))
+
+
+@functools.cache
+def get_upsert_statement(type: Type, mode: ProcessMode) -> PreparedStatement:
+    """`insert ... on conflict do update` for the model fields of `type`, with
+    an array per field unnested in bulk mode or a parameter per field
+    otherwise. Rows identical to the stored ones aren't written, only the
+    written rows are returned with whether they were inserted."""
+    model_fields = DATA_MAPPING[type].model.model_fields
+    primary_key = DATA_MAPPING[type].primary_key
+    fields = [f.lower() for f in model_fields]
+    fields_without_primary_key = fields[:]
+    fields_without_primary_key.remove(primary_key)
+    types = [get_pg_type(field.annotation) for field in model_fields.values()]
+
+    if mode is ProcessMode.BULK:
+        types = [f"{pg_type}[]" for pg_type in types]
+        values_sql = sql.SQL("select * from unnest({})").format(
+            _placeholders(len(fields))
+        )
+    else:
+        values_sql = sql.SQL("values({})").format(_placeholders(len(fields)))
+    table = sql.Identifier(DATA_MAPPING[type].table)
+    statement = sql.SQL(
+        "insert into {table}({fields}) {values} on conflict ({pk}) do update set {set}"
+        " where ({stored}) is distinct from ({excluded}) returning xmax = 0"
+    ).format(
+        table=table,
+        fields=sql.SQL(", ").join(sql.Identifier(f) for f in fields),
+        values=values_sql,
+        pk=sql.Identifier(primary_key),
+        set=sql.SQL(", ").join(
+            sql.SQL("{} = excluded.{}").format(sql.Identifier(f), sql.Identifier(f))
+            for f in fields_without_primary_key
+        ),
+        stored=sql.SQL(", ").join(
+            sql.Identifier(table.string, f) for f in fields_without_primary_key
+        ),
+        excluded=sql.SQL(", ").join(
+            sql.Identifier("excluded", f) for f in fields_without_primary_key
+        ),
+    )
+    return PreparedStatement(f"idfp_upsert_{type.value}_{mode.value}", statement, types)
+
+
+@functools.cache
+def get_delete_statement(type: Type, mode: ProcessMode) -> PreparedStatement:
+    """Delete an array of keys returning the deleted ones in bulk mode, a
+    single key otherwise"""
+    table = DATA_MAPPING[type].table
+    primary_key = DATA_MAPPING[type].primary_key
+    key_type = get_pg_type(
+        DATA_MAPPING[type].model.model_fields[DATA_MAPPING[type].primary_key_field].annotation
+    )
+    if mode is ProcessMode.BULK:
+        statement = sql.SQL(
+            "delete from {table} using unnest($1) as k(key) where {table}.{pk} = k.key returning {table}.{pk}"
+        ).format(table=sql.Identifier(table), pk=sql.Identifier(primary_key))
+        key_type = f"{key_type}[]"
+    else:
+        statement = sql.SQL("delete from {} where {} = $1").format(
+            sql.Identifier(table), sql.Identifier(primary_key)
+        )
+    return PreparedStatement(
+        f"idfp_delete_{type.value}_{mode.value}", statement, [key_type]
+    )
+
+
+@functools.cache
+def get_mark_processed_statement(type: Type) -> PreparedStatement:
+    """Set the processing time of an array of staged rows of a source"""
+    statement = sql.SQL(
+        "update {} set processed_at = $1 where source_id = $2 and id = any($3)"
+    ).format(sql.Identifier(DATA_MAPPING[type].csv_table))
+    return PreparedStatement(
+        f"idfp_mark_processed_{type.value}", statement, ["integer", "integer", "integer[]"]
+    )
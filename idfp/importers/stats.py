@@ -0,0 +1,106 @@
+"""Counters and timings of the import phases.
+
+A phase is logged when it ends and merged into `sources.stats`, summed over
+the processes working on the source (see migrations/005_sources_stats.sql).
+"""
+import dataclasses
+import json
+import logging
+import time
+import typing as t
+
+from psycopg2._psycopg import connection, cursor
+
+from idfp.metrics import observe_import_phase
+
+logger = logging.getLogger(__name__)
+
+
+class StatsCursor(cursor):
+    """Count the statements of a phase and the time spent in them"""
+
+    stats: "PhaseStats"
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self.stats.round_trips += 1
+            self.stats.sql_time += time.perf_counter() - start
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            # one statement per parameters set
+            self.stats.round_trips += len(vars_list)
+            self.stats.sql_time += time.perf_counter() - start
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            self.stats.round_trips += 1
+            self.stats.sql_time += time.perf_counter() - start
+
+
+@dataclasses.dataclass
+class PhaseStats:
+    phase: str
+    duration: float = 0.0
+    rows_in: int = 0
+    rows_out: int = 0
+    rows_rejected: int = 0
+    # outcome of the upserted rows, unchanged ones aren't written
+    rows_inserted: int = 0
+    rows_updated: int = 0
+    rows_unchanged: int = 0
+    batches: int = 0
+    round_trips: int = 0
+    validation_time: float = 0.0
+    sql_time: float = 0.0
+    started_at: float = dataclasses.field(default_factory=time.perf_counter)
+
+    def cursor(self, db_conn: connection) -> StatsCursor:
+        cur = db_conn.cursor(cursor_factory=StatsCursor)
+        cur.stats = self
+        return cur
+
+    def add_upserts(self, counts: t.Mapping[str, int]):
+        self.rows_inserted += counts["inserted"]
+        self.rows_updated += counts["updated"]
+        self.rows_unchanged += counts["unchanged"]
+
+    def as_dict(self) -> dict[str, t.Union[int, float]]:
+        return {
+            f.name: round(v, 4) if isinstance(v, float) else v
+            for f in dataclasses.fields(self)
+            if f.name not in ("phase", "started_at")
+            for v in [getattr(self, f.name)]
+        }
+
+    def finish(self, db_conn: connection, source_id: int):
+        """Log the phase and add it to the stats of the source"""
+        self.duration = time.perf_counter() - self.started_at
+        stats = self.as_dict()
+        observe_import_phase(self.phase, stats)
+        logger.info(
+            f"Done {self.phase} of source {source_id} in {self.duration:.3f}s",
+            extra={"source_id": source_id, "phase": self.phase, "stats": stats},
+        )
+        with db_conn.cursor() as cur:
+            cur.execute(
+                """update sources
+                set stats = stats || jsonb_build_object(%(phase)s, (
+                    select jsonb_object_agg(
+                        key, coalesce((stats -> %(phase)s ->> key)::numeric, 0) + value::numeric
+                    )
+                    from jsonb_each_text(%(stats)s::jsonb)
+                ))
+                where id = %(source_id)s""",
+                {"phase": self.phase, "stats": json.dumps(stats), "source_id": source_id},
+            )
+            db_conn.commit()
@@ -0,0 +1,200 @@
+import csv
+import io
+import itertools
+import logging
+import os
+import time
+import typing as t
+
+from psycopg2 import sql
+from psycopg2._psycopg import connection, cursor
+from pydantic import ValidationError
+
+from idfp.db import notify_source_processed
+from idfp.definitions import Type, DATA_MAPPING, CSV_ID_FIELD, ProcessMode
+from idfp.importers.base import (
+    create_source,
+    delete_batch,
+    get_database_error,
+    get_missing_key_error,
+    get_primary_key_adapter,
+    record_source_error,
+    release_source,
+    update_source_progress,
+    upsert_batch,
+)
+from idfp.importers.errors import CsvErrorSink, update_source_errors_count
+from idfp.importers.stats import PhaseStats
+from idfp.importers.statements import get_delete_statement, get_upsert_statement
+from idfp.importers.validation import get_batch_validator
+
+logger = logging.getLogger(__name__)
+
+
+def _reserve_ids(cur: cursor, csv_table_name: str, count: int) -> list[int]:
+    cur.execute(
+        "select nextval(pg_get_serial_sequence(%s, %s)) from generate_series(1, %s)",
+        [csv_table_name, CSV_ID_FIELD, count],
+    )
+    return [row[0] for row in cur.fetchall()]
+
+
+def stream_csv(
+    db_conn: connection,
+    type: Type,
+    csv_fd: t.TextIO,
+    *,
+    delimiter: str = ",",
+    quotechar: t.Optional[str] = None,
+    chunk_size: int = 1000,
+    filename: t.Optional[str] = None,
+):
+    """Import and process a csv file in a single read.
+
+    Rows are validated chunk by chunk as they are parsed. Clean rows go
+    straight to the entity table and every row is copied to the staging table
+    already stamped with its source, processed_at and errors, so the staging
+    table is written once per row and memory is bounded by `chunk_size`.
+    Unlike `import_and_process_csv`, the chunks are applied in file order, a
+    delete only comes after the inserts of its own chunk.
+    """
+    if not quotechar:
+        quotechar = '"'
+    type_config = DATA_MAPPING[type]
+    model_fields = list(type_config.model.model_fields.keys())
+    validator = get_batch_validator(type_config.model)
+    primary_key_index = model_fields.index(type_config.primary_key_field)
+    upsert_statement = get_upsert_statement(type, ProcessMode.BULK)
+    delete_statement = get_delete_statement(type, ProcessMode.BULK)
+    key_adapter = get_primary_key_adapter(type)
+    missing_error = get_missing_key_error(type)
+    stats = PhaseStats("stream")
+
+    source_id = create_source(
+        db_conn, type, filename or os.path.basename(csv_fd.name)
+    )
+    try:
+        reader = csv.reader(csv_fd, delimiter=delimiter, quotechar=quotechar)
+        headers = next(reader)
+        columns = [h.lower() for h in headers]
+        fields_indexes = [
+            columns.index(f.lower()) if f.lower() in columns else None
+            for f in model_fields
+        ]
+        is_deleted_index = columns.index("isdeleted")
+        primary_key_index_in_csv = columns.index(type_config.primary_key)
+        copy_sql = sql.SQL("COPY {}({}) FROM STDIN CSV").format(
+            sql.Identifier(type_config.csv_table),
+            sql.SQL(", ").join(
+                sql.Identifier(c)
+                for c in [CSV_ID_FIELD, "source_id", "processed_at", "errors", *columns]
+            ),
+        )
+
+        with stats.cursor(db_conn) as cur:
+            cur.execute(
+                "update sources set processing_started_at = now() where id=%s",
+                [source_id],
+            )
+            error_sink = CsvErrorSink(
+                cur, source_id, type_config.csv_table, mark_staging=False
+            )
+            number_of_records = 0
+            while True:
+                chunk = list(itertools.islice(reader, chunk_size))
+                if not chunk:
+                    break
+                for row in chunk:
+                    if len(row) != len(columns):
+                        raise ValueError(
+                            f"line {reader.line_num}: expected {len(columns)} fields, got {len(row)}"
+                        )
+                # COPY reads an unquoted empty field as NULL
+                chunk = [[v if v != "" else None for v in row] for row in chunk]
+                record_ids = _reserve_ids(cur, type_config.csv_table, len(chunk))
+
+                insert_ids = []
+                batch = []
+                tombstones = []
+                processed_ids = set()
+                errors_by_id: dict[int, str] = {}
+                for record_id, row in zip(record_ids, chunk):
+                    is_deleted = (row[is_deleted_index] or "").lower()
+                    if is_deleted == "false":
+                        processed_ids.add(record_id)
+                        insert_ids.append(record_id)
+                        batch.append(
+                            {
+                                f: row[i] if i is not None else None
+                                for f, i in zip(model_fields, fields_indexes)
+                            }
+                        )
+                    elif is_deleted == "true":
+                        processed_ids.add(record_id)
+                        tombstones.append((row[primary_key_index_in_csv], record_id))
+                insert_data = []
+                validation_start = time.perf_counter()
+                results = validator.validate(batch)
+                stats.validation_time += time.perf_counter() - validation_start
+                for record_id, result in zip(insert_ids, results):
+                    if isinstance(result, ValidationError):
+                        errors_by_id[record_id] = result.json()
+                    else:
+                        insert_data.append((record_id, validator.values(result)))
+
+                counts, failed = upsert_batch(
+                    cur, upsert_statement, insert_data, primary_key_index
+                )
+                for record_id, exc in failed:
+                    errors_by_id[record_id] = get_database_error(exc)
+                stats.add_upserts(counts)
+                stats.rows_out += len(insert_data) - len(failed)
+                if tombstones:
+                    deleted_record_ids, missing_record_ids = delete_batch(
+                        cur, delete_statement, key_adapter, tombstones
+                    )
+                    for record_id in missing_record_ids:
+                        errors_by_id[record_id] = missing_error
+                    stats.rows_out += len(deleted_record_ids)
+                stats.batches += 1
+                stats.rows_in += len(chunk)
+                stats.rows_rejected += len(errors_by_id)
+
+                processed_at = int(time.time())
+                staged = io.StringIO()
+                writer = csv.writer(staged)
+                for record_id, row in zip(record_ids, chunk):
+                    writer.writerow(
+                        [
+                            record_id,
+                            source_id,
+                            # rows neither inserted nor deleted stay pending,
+                            # same as after a plain import
+                            processed_at if record_id in processed_ids else 0,
+                            errors_by_id.get(record_id),
+                            *row,
+                        ]
+                    )
+                staged.seek(0)
+                cur.copy_expert(copy_sql, staged)
+                for record_id, errors in errors_by_id.items():
+                    error_sink.add(record_id, errors)
+                error_sink.flush()
+                update_source_progress(cur, source_id, len(processed_ids))
+                number_of_records += len(chunk)
+                db_conn.commit()
+            # only now that the whole file is staged, see `resume_source`
+            cur.execute(
+                "update sources set number_of_records = %s, processed_at = now() where id=%s",
+                [number_of_records, source_id],
+            )
+            update_source_errors_count(cur, source_id)
+            notify_source_processed(cur, source_id)
+            db_conn.commit()
+    except Exception as exc:
+        record_source_error(db_conn, source_id, exc)
+        raise exc
+    finally:
+        release_source(db_conn, source_id)
+    stats.finish(db_conn, source_id)
+    return source_id
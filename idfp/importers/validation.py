@@ -0,0 +1,79 @@
+import enum
+import functools
+import typing as t
+
+import pydantic
+from pydantic import TypeAdapter, ValidationError, WrapValidator
+from typing_extensions import TypedDict
+
+
+def _catch_validation_error(value: t.Any, handler: t.Callable) -> t.Any:
+    try:
+        return handler(value)
+    except ValidationError as err:
+        return err
+
+
+def _row_type(model: type[pydantic.BaseModel]) -> type:
+    """A TypedDict with the fields of `model`, validated the same way without
+    building model instances. The model itself when it has validators of its
+    own, which the TypedDict would miss."""
+    decorators = model.__pydantic_decorators__
+    if (
+        decorators.validators
+        or decorators.field_validators
+        or decorators.root_validators
+        or decorators.model_validators
+    ):
+        return model
+    row_type = TypedDict(
+        model.__name__,
+        {
+            name: t.Annotated[(field.annotation, *field.metadata)]
+            if field.metadata
+            else field.annotation
+            for name, field in model.model_fields.items()
+        },
+    )
+    row_type.__pydantic_config__ = model.model_config
+    return row_type
+
+
+class BatchValidator:
+    """Validate a whole batch of rows against a model in one call.
+
+    Each row comes back either as a dict of the coerced field values or as the
+    `ValidationError` the model would have raised for it.
+    """
+
+    def __init__(self, model: type[pydantic.BaseModel]):
+        self.model = model
+        self.fields = list(model.model_fields.keys())
+        self.row_type = _row_type(model)
+        self.adapter = TypeAdapter(
+            list[t.Annotated[self.row_type, WrapValidator(_catch_validation_error)]]
+        )
+
+    def validate(
+        self, rows: list[dict[str, t.Any]]
+    ) -> list[t.Union[dict[str, t.Any], ValidationError]]:
+        results = self.adapter.validate_python(rows)
+        if self.row_type is self.model:
+            return [
+                result if isinstance(result, ValidationError) else dict(result)
+                for result in results
+            ]
+        return results
+
+    def values(self, row: dict[str, t.Any]) -> list[t.Any]:
+        """The coerced values of a validated row in the order of the model
+        fields, as psycopg2 adapts them to typed literals"""
+        return [
+            value.value if isinstance(value, enum.Enum) else value
+            for value in map(row.__getitem__, self.fields)
+        ]
+
+
+@functools.cache
+def get_batch_validator(model: type[pydantic.BaseModel]) -> BatchValidator:
+    return BatchValidator(model)
@@ -1,9 +1,10 @@
 import logging
+import os
 import click
 import typing as t
 
 from idfp.db import get_db_conn
-from idfp.definitions import Type
+from idfp.definitions import Type, ProcessMode
 from idfp.config import AppConfiguration, configure
 
 logger = logging.getLogger(__name__)
@@ -21,6 +22,35 @@ def cli(ctx: click.Context, config_fo: t.BinaryIO):
     logger.info(f"Loading configuration from {config_fo.name}")
     config = configure(config_fo)
     ctx.obj['config'] = config
+    if config.metrics_dir:
+        import atexit
+
+        # read by prometheus_client when imported, see idfp.metrics
+        os.environ["PROMETHEUS_MULTIPROC_DIR"] = config.metrics_dir
+        from idfp import metrics
+
+        try:
+            metrics.check_metrics_dir(config.metrics_dir)
+        except OSError as exc:
+            raise click.ClickException(str(exc))
+        # also run by the forked gunicorn workers on exit, not by the
+        # multiprocessing children which their parent merges
+        atexit.register(metrics.merge_dead_processes, exiting=True)
+
+
+mode_option = click.option(
+    "--mode",
+    "mode_str",
+    default=ProcessMode.ROW.value,
+    type=click.Choice([m.value for m in ProcessMode]),
+    help="Write valid rows one by one or with one statement per batch",
+)
+workers_option = click.option(
+    "--workers",
+    default=1,
+    type=click.IntRange(min=1),
+    help="Number of processes validating the staged rows",
+)
 
 
 @cli.command()
@@ -44,29 +74,188 @@ def import_area_csv(ctx: click.Context, fp: str, delimiter: str, quotechar: str)
 
 
 @cli.command()
-@click.argument("file", type=click.File('r'))
+@click.argument("file")
 @click.argument("type_str", metavar='TYPE')
 @click.option("--delimiter", default=",", type=str)
 @click.option("--quotechar", default='"', type=str)
+@mode_option
+@workers_option
+@click.option(
+    "--stream",
+    is_flag=True,
+    help="Validate and write rows while reading the file, in a single pass",
+)
+@click.option(
+    "--copy-workers",
+    type=click.IntRange(min=1),
+    help="Stage FILE, a file, a directory or a glob pattern, in chunks over this number of connections",
+)
 @click.pass_context
 def import_csv(
-    ctx: click.Context, file: t.TextIO, type_str: str, delimiter: str, quotechar: str
+    ctx: click.Context,
+    file: str,
+    type_str: str,
+    delimiter: str,
+    quotechar: str,
+    mode_str: str,
+    workers: int,
+    stream: bool,
+    copy_workers: t.Optional[int],
 ):
     from idfp.importers import importers
 
+    if stream and workers > 1:
+        raise click.BadOptionUsage("workers", "--workers can't be used with --stream")
+    if stream and copy_workers:
+        raise click.BadOptionUsage(
+            "copy_workers", "--copy-workers can't be used with --stream"
+        )
+
     type = Type(type_str)
     importer = importers[type]
 
-    with get_db_conn(ctx.obj["config"]) as db_conn:
+    if copy_workers:
+        from idfp.importers.parallel_copy import import_and_process_paths
+
+        with get_db_conn(ctx.obj["config"]) as db_conn:
+            try:
+                import_and_process_paths(
+                    db_conn=db_conn,
+                    config=ctx.obj["config"],
+                    type=type,
+                    pattern=file,
+                    delimiter=delimiter,
+                    quotechar=quotechar,
+                    mode=ProcessMode(mode_str),
+                    workers=workers,
+                    copy_workers=copy_workers,
+                )
+            except Exception as exc:
+                db_conn.rollback()
+                raise exc
+        return
+
+    from idfp.importers.csv_io import csv_filename, open_csv
+
+    with get_db_conn(ctx.obj["config"]) as db_conn, click.open_file(file, "rb") as fo:
         try:
             importer(
-                db_conn=db_conn, csv_fo=file, delimiter=delimiter, quotechar=quotechar
+                db_conn=db_conn,
+                # decompressed while read when compressed
+                csv_fo=open_csv(fo),
+                filename=csv_filename(os.path.basename(fo.name)),
+                delimiter=delimiter,
+                quotechar=quotechar,
+                mode=ProcessMode(mode_str),
+                workers=workers,
+                config=ctx.obj["config"],
+                stream=stream,
             )
         except Exception as exc:
             db_conn.rollback()
             raise exc
 
 
+@cli.command()
+@click.argument("source_id", type=int)
+@mode_option
+@workers_option
+@click.pass_context
+def resume(ctx: click.Context, source_id: int, mode_str: str, workers: int):
+    """Process the staged rows of a source left pending by an interruption"""
+    from idfp.importers.base import SourceBusyError, resume_source
+
+    with get_db_conn(ctx.obj["config"]) as db_conn:
+        try:
+            resume_source(
+                db_conn,
+                source_id,
+                mode=ProcessMode(mode_str),
+                workers=workers,
+                config=ctx.obj["config"],
+            )
+        except (ValueError, SourceBusyError) as exc:
+            raise click.ClickException(str(exc))
+
+
+@cli.command()
+@mode_option
+@workers_option
+@click.pass_context
+def process_pending(ctx: click.Context, mode_str: str, workers: int):
+    """Resume every source whose processing didn't finish"""
+    from idfp.importers.base import (
+        SourceBusyError,
+        get_pending_sources,
+        resume_source,
+    )
+
+    with get_db_conn(ctx.obj["config"]) as db_conn:
+        for source_id in get_pending_sources(db_conn):
+            click.echo(f"Resuming source {source_id}")
+            try:
+                resume_source(
+                    db_conn,
+                    source_id,
+                    mode=ProcessMode(mode_str),
+                    workers=workers,
+                    config=ctx.obj["config"],
+                )
+            except SourceBusyError:
+                click.echo(f"Source {source_id} is being processed, skipped")
+
+
+@cli.command()
+@click.option(
+    "--concurrency",
+    default=1,
+    type=click.IntRange(min=1),
+    help="Number of sources processed at the same time",
+)
+@mode_option
+@click.option(
+    "--poll-interval",
+    default=5.0,
+    type=click.FloatRange(min=0, min_open=True),
+    help="Seconds between checks of the queue when nothing notifies it",
+)
+@click.pass_context
+def worker(ctx: click.Context, concurrency: int, mode_str: str, poll_interval: float):
+    """Process the sources queued by the web upload"""
+    from idfp.importers.queue import run_workers
+
+    run_workers(
+        ctx.obj["config"],
+        concurrency=concurrency,
+        mode=ProcessMode(mode_str),
+        poll_interval=poll_interval,
+    )
+
+
+@cli.command()
+@click.option(
+    "--older-than",
+    "older_than_days",
+    required=True,
+    type=click.IntRange(min=0),
+    help="Age in days of the sources to drop",
+)
+@click.pass_context
+def drop_partitions(ctx: click.Context, older_than_days: int):
+    """Drop the staging and csv errors partitions of old sources"""
+    from contextlib import closing
+    from datetime import date, timedelta
+    from idfp.partitions import drop_source_partitions
+
+    # not `with db_conn`, which would open a transaction even in autocommit
+    with closing(get_db_conn(ctx.obj["config"])) as db_conn:
+        source_ids = drop_source_partitions(
+            db_conn, date.today() - timedelta(days=older_than_days)
+        )
+    for source_id in source_ids:
+        click.echo(source_id)
+
+
 @cli.command()
 @click.pass_context
 def web(ctx: click.Context):
@@ -93,6 +282,7 @@ def web(ctx: click.Context):
     if config.web_workers:
         gunicorn_cfg.workers = config.web_workers
     gunicorn_cfg.reuse_port = config.web_reuse_port
+    gunicorn_cfg.timeout = config.web_timeout
 
     # save and restore `sys.argv` to make USR2 handling work
     old_sys_argv = sys.argv[:]
@@ -0,0 +1,164 @@
+"""Prometheus metrics of the web tier and the importers.
+
+They are only collected when prometheus_client is installed (the `metrics`
+extra). With `metrics_dir` configured, every process, gunicorn workers and
+importers alike, writes its samples to files in that directory and `/metrics`
+aggregates all of them. Without it each process only exposes its own.
+
+prometheus_client picks its multiprocess mode when imported, the cli exports
+`metrics_dir` as PROMETHEUS_MULTIPROC_DIR before anything imports this module.
+
+Each process writes to files of its own, which outlive it. The samples of the
+processes that exited are folded into one file per metric type (see
+`merge_dead_processes`), so that the import commands and the worker processes
+don't leave files behind for every scrape to read.
+"""
+import contextlib
+import fcntl
+import os
+import stat
+import typing as t
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+    from prometheus_client.mmap_dict import MmapedDict
+except ImportError:
+    prometheus_client = None
+
+MULTIPROC_DIR_ENV = "PROMETHEUS_MULTIPROC_DIR"
+
+# the types whose samples add up across processes, the only ones defined here
+MERGED_TYPES = ("counter", "histogram")
+
+
+def check_metrics_dir(directory: str):
+    """Create the directory of the samples, or make sure that only this user
+    can write to it. Files planted by someone else would be read by /metrics,
+    so the web server and the import commands have to run as the same user."""
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    st = os.stat(directory)
+    if st.st_uid != os.geteuid():
+        raise PermissionError(f"{directory} isn't owned by the idfp user")
+    if st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise PermissionError(f"{directory} is writable by other users")
+
+
+@contextlib.contextmanager
+def _merge_lock(metrics_dir: str, operation: int):
+    # released when closed
+    with open(os.path.join(metrics_dir, "merge.lock"), "a") as lock_fo:
+        fcntl.flock(lock_fo, operation)
+        yield
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def merge_dead_processes(*, exiting: bool = False):
+    """Add the counters and histograms of the processes that exited, and of
+    this one when `exiting`, to the merged files, then remove their files.
+    The files of the running processes are left alone."""
+    metrics_dir = os.environ.get(MULTIPROC_DIR_ENV)
+    if prometheus_client is None or not metrics_dir:
+        return
+    with _merge_lock(metrics_dir, fcntl.LOCK_EX):
+        for entry in os.scandir(metrics_dir):
+            # <type>_<pid>.db
+            typ, _, pid = entry.name.removesuffix(".db").partition("_")
+            if typ not in MERGED_TYPES or not pid.isdigit():
+                continue
+            if int(pid) == os.getpid() and not exiting:
+                continue
+            if int(pid) != os.getpid() and _is_alive(int(pid)):
+                continue
+            merged = MmapedDict(os.path.join(metrics_dir, f"{typ}_merged.db"))
+            try:
+                for key, value, timestamp, _ in MmapedDict.read_all_values_from_file(
+                    entry.path
+                ):
+                    merged.write_value(key, merged.read_value(key)[0] + value, timestamp)
+            finally:
+                merged.close()
+            os.remove(entry.path)
+
+
+def mark_process_dead(pid: int):
+    if prometheus_client is not None and os.environ.get(MULTIPROC_DIR_ENV):
+        multiprocess.mark_process_dead(pid)
+
+
+if prometheus_client is not None:
+    REQUEST_DURATION = prometheus_client.Histogram(
+        "idfp_request_duration_seconds",
+        "Time to respond to a request, until the body starts streaming",
+        ["view", "method", "status"],
+    )
+    DB_ACQUIRE_DURATION = prometheus_client.Histogram(
+        "idfp_db_acquire_duration_seconds",
+        "Time to get a connection from the pool of a web worker",
+        ["pool"],
+        buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0),
+    )
+    IMPORT_PHASE_DURATION = prometheus_client.Histogram(
+        "idfp_import_phase_duration_seconds",
+        "Duration of the import phases, per process",
+        ["phase"],
+        buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600),
+    )
+    IMPORT_ROWS = prometheus_client.Counter(
+        "idfp_import_rows",
+        "Rows through the import phases",
+        ["phase", "outcome"],
+    )
+    IMPORT_ROUND_TRIPS = prometheus_client.Counter(
+        "idfp_import_round_trips",
+        "Database statements of the import phases",
+        ["phase"],
+    )
+
+
+def observe_request(view: str, method: str, status: int, seconds: float):
+    if prometheus_client is not None:
+        REQUEST_DURATION.labels(view, method, str(status)).observe(seconds)
+
+
+def observe_db_acquire(pool: str, seconds: float):
+    if prometheus_client is not None:
+        DB_ACQUIRE_DURATION.labels(pool).observe(seconds)
+
+
+def observe_import_phase(phase: str, stats: dict[str, t.Union[int, float]]):
+    if prometheus_client is None:
+        return
+    IMPORT_PHASE_DURATION.labels(phase).observe(stats["duration"])
+    for outcome in ("in", "out", "rejected", "inserted", "updated", "unchanged"):
+        IMPORT_ROWS.labels(phase, outcome).inc(stats[f"rows_{outcome}"])
+    IMPORT_ROUND_TRIPS.labels(phase).inc(stats["round_trips"])
+
+
+if prometheus_client is not None:
+
+    class _MultiProcessCollector(multiprocess.MultiProcessCollector):
+        """Reads the files while no process is being merged, which would
+        count its samples twice or remove its files from under the reads"""
+
+        def collect(self):
+            with _merge_lock(self._path, fcntl.LOCK_SH):
+                return list(super().collect())
+
+
+def get_registry() -> "prometheus_client.CollectorRegistry":
+    """The samples of every process sharing the directory, or of this one"""
+    if os.environ.get(MULTIPROC_DIR_ENV):
+        registry = prometheus_client.CollectorRegistry()
+        _MultiProcessCollector(registry)
+        return registry
+    return prometheus_client.REGISTRY
@@ -0,0 +1,110 @@
+import logging
+from datetime import date
+
+from psycopg2 import sql
+from psycopg2._psycopg import connection, cursor
+
+from idfp.definitions import Type, DATA_MAPPING
+
+logger = logging.getLogger(__name__)
+
+CSV_ERRORS_TABLE = "csv_errors"
+
+
+def partition_name(table: str, source_id: int) -> str:
+    return f"{table}_{source_id}"
+
+
+def is_partitioned(cur: cursor, table: str) -> bool:
+    cur.execute("select relkind = 'p' from pg_class where oid = %s::regclass", [table])
+    row = cur.fetchone()
+    return bool(row and row[0])
+
+
+def create_source_partitions(cur: cursor, type: Type, source_id: int):
+    """Create the staging and csv_errors partitions of a new source, if the
+    tables are partitioned (see migrations/002_staging_partitions.sql)"""
+    for table in (DATA_MAPPING[type].csv_table, CSV_ERRORS_TABLE):
+        if not is_partitioned(cur, table):
+            continue
+        partition = sql.Identifier(partition_name(table, source_id))
+        # create then attach, unlike `create table ... partition of` attaching
+        # doesn't lock the parent table against reads and writes. There is no
+        # default partition, which attaching would lock.
+        cur.execute(
+            sql.SQL(
+                "create table {} (like {} including defaults, check (source_id = {}))"
+            ).format(partition, sql.Identifier(table), sql.Literal(source_id))
+        )
+        cur.execute(
+            sql.SQL("alter table {} attach partition {} for values from ({}) to ({})").format(
+                sql.Identifier(table),
+                partition,
+                sql.Literal(source_id),
+                sql.Literal(source_id + 1),
+            )
+        )
+
+
+def _detach_partition(cur: cursor, table: str, partition: str):
+    """Detach `partition` from `table` without locking `table` against the
+    readers, in autocommit: detaching concurrently runs two transactions.
+    Finishes the detach of a previous run interrupted between them."""
+    cur.execute(
+        "select inhdetachpending from pg_inherits where inhrelid = %s::regclass",
+        [partition],
+    )
+    row = cur.fetchone()
+    if row is None:
+        # already detached
+        return
+    cur.execute(
+        sql.SQL("alter table {} detach partition {} {}").format(
+            sql.Identifier(table),
+            sql.Identifier(partition),
+            sql.SQL("finalize" if row[0] else "concurrently"),
+        )
+    )
+
+
+def drop_source_partitions(db_conn: connection, before: date) -> list[int]:
+    """Drop the partitions of the sources submitted before `before`,
+    return the ids of these sources.
+
+    `drop table` on an attached partition would take an ACCESS EXCLUSIVE lock
+    on the parent table and queue every query of the table behind the longest
+    running one, e.g. an export of the /query page. The partitions are
+    detached concurrently first, which waits for these queries without
+    blocking the others, then dropped on their own. `db_conn` can't be in a
+    transaction, nor used in a `with` block which opens one."""
+    dropped = set()
+    autocommit = db_conn.autocommit
+    db_conn.autocommit = True
+    try:
+        with db_conn.cursor() as cur:
+            tables = [(DATA_MAPPING[type].csv_table, type.value) for type in Type]
+            tables.append((CSV_ERRORS_TABLE, None))
+            for table, type in tables:
+                cur.execute(
+                    """select id from sources
+                    where submitted_date < %s
+                    and (%s is null or type = %s)
+                    and to_regclass(%s || '_' || id) is not null
+                    order by id""",
+                    [before, type, type, table],
+                )
+                for (source_id,) in cur.fetchall():
+                    partition = partition_name(table, source_id)
+                    _detach_partition(cur, table, partition)
+                    cur.execute(sql.SQL("drop table {}").format(sql.Identifier(partition)))
+                    if table == CSV_ERRORS_TABLE:
+                        # nothing left to download
+                        cur.execute(
+                            "update sources set csv_errors_count = 0 where id = %s",
+                            [source_id],
+                        )
+                    dropped.add(source_id)
+    finally:
+        db_conn.autocommit = autocommit
+    logger.info(f"Dropped partitions of {len(dropped)} sources")
+    return sorted(dropped)
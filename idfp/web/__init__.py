@@ -14,17 +14,40 @@ def create_app(config: AppConfiguration):
     )
     app.config['config'] = config
 
+    if config.query_cache == "file":
+        from idfp.web.query_cache import check_query_cache_dir
+
+        # refuse to start rather than fail every /query
+        check_query_cache_dir(config.query_cache_dir)
+
+    from idfp.web.db import return_db_conns
+    app.teardown_appcontext(return_db_conns)
+
     from idfp.web.views import (
         index_view,
         sources_views,
+        upload_view,
         csv_errors_download,
         query_view,
     )
     app.route("/")(index_view)
     app.route("/sources")(sources_views)
+    app.route("/sources/upload", methods=["GET", "POST"])(upload_view)
     app.route("/csv-errors/download")(csv_errors_download)
     app.route("/query", methods=["GET", "POST"])(query_view)
 
+    from idfp import metrics
+    if metrics.prometheus_client is not None:
+        from idfp.web.metrics import (
+            metrics_view,
+            observe_request,
+            start_request_timer,
+        )
+
+        app.before_request(start_request_timer)
+        app.after_request(observe_request)
+        app.route("/metrics")(metrics_view)
+
     if config.debug:
         from werkzeug.debug import DebuggedApplication
 
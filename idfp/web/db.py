@@ -0,0 +1,56 @@
+import logging
+import time
+
+import psycopg2
+from flask import current_app, g
+from psycopg2._psycopg import connection
+
+from idfp.config import AppConfiguration
+from idfp.db import get_db_pool
+from idfp.metrics import observe_db_acquire
+
+logger = logging.getLogger(__name__)
+
+
+def _get_pooled_conn(key: str, reader: bool) -> connection:
+    if key not in g:
+        config: AppConfiguration = current_app.config["config"]
+        started_at = time.perf_counter()
+        setattr(g, key, get_db_pool(config, reader=reader).getconn())
+        observe_db_acquire(
+            "reader" if reader else "writer", time.perf_counter() - started_at
+        )
+    return getattr(g, key)
+
+
+def get_db() -> connection:
+    """Writer connection of the current request, back to the pool on teardown"""
+    return _get_pooled_conn("db_conn", False)
+
+
+def get_reader_db() -> connection:
+    """Reader connection of the current request, back to the pool on teardown"""
+    return _get_pooled_conn("db_reader_conn", True)
+
+
+def return_db_conns(exc=None):
+    config: AppConfiguration = current_app.config["config"]
+    for key, reader in (("db_conn", False), ("db_reader_conn", True)):
+        db_conn = g.pop(key, None)
+        if db_conn is None:
+            continue
+        broken = bool(db_conn.closed)
+        if not broken:
+            try:
+                db_conn.rollback()
+                if reader:
+                    # the /query console runs anything, don't leak its session
+                    # settings to the next request
+                    db_conn.autocommit = True
+                    with db_conn.cursor() as cur:
+                        cur.execute("discard all")
+                    db_conn.autocommit = False
+            except psycopg2.Error:
+                logger.exception("Discarding a broken connection")
+                broken = True
+        get_db_pool(config, reader=reader).putconn(db_conn, close=broken)
@@ -13,3 +13,22 @@ logger_class = DisabledLogger
 # set this to anything to force gunicorn log on requests
 accesslog = "-"
 workers = multiprocessing.cpu_count() * 2 + 1
+
+
+def worker_exit(server, worker):
+    from idfp.db import close_db_pools
+
+    close_db_pools()
+
+
+def on_starting(server):
+    from idfp.metrics import merge_dead_processes
+
+    merge_dead_processes()
+
+
+def child_exit(server, worker):
+    from idfp.metrics import mark_process_dead, merge_dead_processes
+
+    mark_process_dead(worker.pid)
+    merge_dead_processes()
@@ -0,0 +1,29 @@
+import time
+
+from flask import Response, g, request
+
+from idfp import metrics
+
+
+def start_request_timer():
+    g.request_started_at = time.perf_counter()
+
+
+def observe_request(response: Response) -> Response:
+    started_at = g.pop("request_started_at", None)
+    if started_at is not None:
+        metrics.observe_request(
+            request.endpoint or "",
+            request.method,
+            response.status_code,
+            time.perf_counter() - started_at,
+        )
+    return response
+
+
+def metrics_view():
+    from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+    return Response(
+        generate_latest(metrics.get_registry()), mimetype=CONTENT_TYPE_LATEST
+    )
@@ -0,0 +1,246 @@
+"""Result cache of the /query console.
+
+Entries expire after a TTL and the least recently used ones are evicted past a
+size limit. The cache is emptied whenever a source finishes processing: the
+importers notify `SOURCE_PROCESSED_CHANNEL` and every web worker listens to it
+on a connection of its own.
+"""
+import collections
+import hashlib
+import logging
+import os
+import pickle
+import re
+import select
+import stat
+import tempfile
+import time
+import typing as t
+
+import psycopg2
+
+from idfp.config import AppConfiguration
+from idfp.db import SOURCE_PROCESSED_CHANNEL, get_db_reader_conn
+
+logger = logging.getLogger(__name__)
+
+# quoted literals and identifiers, whitespace in them is significant, and
+# comments, whose quotes don't open anything
+_VERBATIM_RE = re.compile(
+    r"(?<!\w)[eE]'(?:[^'\\]|\\.|'')*'"
+    r"|'(?:[^']|'')*'"
+    r'|"(?:[^"]|"")*"'
+    r"|(\$\w*\$).*?\1"
+    r"|--[^\n]*"
+    r"|/\*.*?\*/",
+    re.S,
+)
+
+
+def _collapse_whitespace(part: str) -> str:
+    part = re.sub(r"[ \t]+", " ", part)
+    return re.sub(r" ?\n\s*", "\n", part)
+
+
+def normalize_sql(query: str) -> str:
+    """Collapse the whitespace outside of the quoted parts and comments of
+    `query`. Line breaks are kept, they end `--` comments."""
+    query = query.strip().rstrip(";").strip()
+    parts = []
+    position = 0
+    for match in _VERBATIM_RE.finditer(query):
+        parts.append(_collapse_whitespace(query[position : match.start()]))
+        parts.append(match.group())
+        position = match.end()
+    parts.append(_collapse_whitespace(query[position:]))
+    return "".join(parts)
+
+
+def query_cache_key(query: str, row_limit: int) -> str:
+    return hashlib.sha256(f"{row_limit}:{normalize_sql(query)}".encode()).hexdigest()
+
+
+class MemoryQueryCache:
+    """LRU of pickled results within a single process"""
+
+    def __init__(self, ttl: int, max_bytes: int):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries: collections.OrderedDict[str, tuple[float, bytes]] = (
+            collections.OrderedDict()
+        )
+
+    def get(self, key: str) -> t.Any:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, data = entry
+        if expires_at < time.time():
+            self._remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return pickle.loads(data)
+
+    def set(self, key: str, value: t.Any):
+        data = pickle.dumps(value)
+        if len(data) > self.max_bytes:
+            return
+        self._remove(key)
+        self.entries[key] = (time.time() + self.ttl, data)
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def _remove(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+
+def check_query_cache_dir(directory: str):
+    """Create the directory of the file cache, or make sure that only this
+    user can write to it. Its entries are unpickled, a file planted by someone
+    else would run their code in the web workers."""
+    if not directory:
+        raise ValueError('the "file" query cache needs a query_cache_dir')
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    st = os.stat(directory)
+    if st.st_uid != os.geteuid():
+        raise PermissionError(f"{directory} isn't owned by the web server user")
+    if st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise PermissionError(f"{directory} is writable by other users")
+
+
+class FileQueryCache:
+    """LRU of pickled results shared by the processes of a machine, one file
+    per entry. Point `directory` to a tmpfs like /dev/shm to keep it in memory.
+    """
+
+    def __init__(self, ttl: int, max_bytes: int, directory: str):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.directory = directory
+        check_query_cache_dir(directory)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.pickle")
+
+    def get(self, key: str) -> t.Any:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                expires_at, value = pickle.load(f)
+            if expires_at < time.time():
+                os.remove(path)
+                return None
+            # the modification time orders the entries for eviction
+            os.utime(path)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        return value
+
+    def set(self, key: str, value: t.Any):
+        data = pickle.dumps((time.time() + self.ttl, value))
+        if len(data) > self.max_bytes:
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self._path(key))
+        self._evict()
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".pickle"):
+                self._remove(entry.path)
+
+    def _evict(self):
+        entries = []
+        size = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".pickle"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            size += stat.st_size
+        entries.sort()
+        for _, entry_size, path in entries:
+            if size <= self.max_bytes:
+                break
+            self._remove(path)
+            size -= entry_size
+
+    def _remove(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+QueryCache = t.Union[MemoryQueryCache, FileQueryCache]
+
+_cache: t.Optional[QueryCache] = None
+_listener = None
+_listener_pid: t.Optional[int] = None
+
+
+def _create_query_cache(config: AppConfiguration) -> t.Optional[QueryCache]:
+    if config.query_cache == "memory":
+        return MemoryQueryCache(config.query_cache_ttl, config.query_cache_max_bytes)
+    if config.query_cache == "file":
+        return FileQueryCache(
+            config.query_cache_ttl,
+            config.query_cache_max_bytes,
+            config.query_cache_dir,
+        )
+    return None
+
+
+def _sources_processed(config: AppConfiguration) -> bool:
+    """Whether a source finished processing since the last call"""
+    global _listener, _listener_pid
+    if _listener_pid != os.getpid():
+        # a connection of the parent process, leave it alone
+        _listener = None
+        _listener_pid = os.getpid()
+    try:
+        if _listener is None:
+            _listener = get_db_reader_conn(config)
+            _listener.autocommit = True
+            with _listener.cursor() as cur:
+                cur.execute(f"listen {SOURCE_PROCESSED_CHANNEL}")
+            # anything could have happened while not listening
+            return True
+        if select.select([_listener], [], [], 0)[0]:
+            _listener.poll()
+        if _listener.notifies:
+            _listener.notifies.clear()
+            return True
+        return False
+    except psycopg2.Error:
+        logger.exception("Lost the query cache listener")
+        if _listener is not None:
+            _listener.close()
+        _listener = None
+        return True
+
+
+def get_query_cache(config: AppConfiguration) -> t.Optional[QueryCache]:
+    """The query cache of the current process, emptied of the results that
+    predate the last processed source, or None when caching is disabled"""
+    global _cache
+    if not config.query_cache:
+        return None
+    if _cache is None:
+        _cache = _create_query_cache(config)
+    if _cache is not None and _sources_processed(config):
+        _cache.clear()
+    return _cache
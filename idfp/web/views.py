@@ -1,17 +1,52 @@
 import csv
 import io
+import json
 import logging
 import os
+import unicodedata
+import zlib
+from urllib.parse import quote
 
-from flask import render_template, current_app, request, send_file, abort
+from flask import (
+    Response,
+    abort,
+    current_app,
+    redirect,
+    render_template,
+    request,
+    stream_with_context,
+    url_for,
+)
 from psycopg2 import sql
 
 from idfp.config import AppConfiguration
-from idfp.db import get_db_conn, get_db_reader_conn
 from idfp.definitions import Type, DATA_MAPPING
+from idfp.web.db import get_db, get_reader_db
+from idfp.web.query_cache import get_query_cache, query_cache_key
 
 logger = logging.getLogger(__name__)
 
+CSV_ERRORS_DOWNLOAD_CHUNK_SIZE = 2000
+QUERY_EXPORT_CHUNK_SIZE = 2000
+QUERY_EXPORT_MIMETYPES = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+
+
+def _attachment(filename: str) -> dict[str, str]:
+    """Content-Disposition parameters of a download, encoded like `send_file`
+    does, headers are latin-1 only"""
+    try:
+        filename.encode("ascii")
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize("NFKD", filename).encode("ascii", "ignore")
+        return {
+            "filename": simple.decode("ascii"),
+            "filename*": f"UTF-8''{quote(filename, safe='!#$&+^`|~')}",
+        }
+    return {"filename": filename}
+
 
 def index_view():
     logger.info("hello from idfp")
@@ -22,74 +57,172 @@ def index_view():
 
 def sources_views():
     config: AppConfiguration = current_app.config["config"]
+    before = request.args.get("before", type=int)
 
-    with get_db_conn(config) as db_conn:
+    with get_db() as db_conn:
         with db_conn.cursor() as cur:
-            sources = cur.execute(
+            # one more row than the page tells whether there is a next page
+            cur.execute(
                 """select
                     sources.id,
                     type,
                     filename,
                     submitted_date,
+                    processing_started_at,
                     processed_at,
+                    number_of_records,
+                    number_of_processed_records,
                     errors as source_errors,
-                    exists(select csv_errors.id from csv_errors where csv_errors.source_id=sources.id) as csv_errors
-                from sources
+                    csv_errors_count as csv_errors
+                from (
+                    select * from sources
+                    where %(before)s::int is null or id < %(before)s
+                    order by id desc
+                    limit %(limit)s
+                ) sources
                 left join source_errors
                 on sources.id = source_errors.source_id
-                order by sources.id desc"""
+                order by sources.id desc""",
+                {"before": before, "limit": config.sources_page_size + 1},
             )
 
             headers = [desc[0] for desc in cur.description]
             rows = cur.fetchall()
-    return render_template("sources.j2", headers=headers, rows=rows)
+    next_before = None
+    page_ids = sorted({row[0] for row in rows}, reverse=True)
+    if len(page_ids) > config.sources_page_size:
+        # the extra source only tells there is a next page
+        rows = [row for row in rows if row[0] != page_ids[-1]]
+        next_before = page_ids[-2]
+    return render_template(
+        "sources.j2", headers=headers, rows=rows, before=before, next_before=next_before
+    )
 
 
-def csv_errors_download():
-    config: AppConfiguration = current_app.config["config"]
+def upload_view():
+    error = None
+    if request.method == "POST":
+        from idfp.importers.base import import_csv
+        from idfp.importers.csv_io import csv_filename, open_csv
+        from idfp.importers.queue import enqueue_source
+
+        file = request.files.get("file")
+        try:
+            type = Type(request.form.get("type"))
+        except ValueError:
+            return abort(400)
+        if file is None or not file.filename:
+            return abort(400)
+        db_conn = get_db()
+        try:
+            # staged right away, the processing is left to `idfp worker`
+            source_id = import_csv(
+                db_conn,
+                type,
+                open_csv(file.stream),
+                delimiter=request.form.get("delimiter") or ",",
+                filename=csv_filename(file.filename),
+            )
+            with db_conn.cursor() as cur:
+                enqueue_source(cur, source_id)
+            db_conn.commit()
+        except Exception as e:
+            error = str(e)
+        else:
+            return redirect(url_for("sources_views"))
+    return render_template("upload.j2", types=[t.value for t in Type], error=error)
 
-    csv_data = io.StringIO()
-    csv_writer = csv.writer(csv_data)
 
+def csv_errors_download():
     try:
         source_id = int(request.args.get("source_id"))
     except Exception:
         return abort(404)
 
-    with get_db_conn(config) as db_conn:
-        with db_conn.cursor() as cur:
-            cur.execute("select type, filename from sources where id = %s", [source_id])
-            row = cur.fetchone()
-            source_type = Type(row[0])
-            filename = os.path.splitext(row[1])[0] + '_errors.csv'
-            csv_table_name = DATA_MAPPING[source_type].csv_table
-            model = DATA_MAPPING[source_type].model
-            fields = [f.lower() for f in model.model_fields.keys()]+['isdeleted']
-            fields_select_sql = ", ".join(fields)
-            cur.execute(
-                sql.SQL(
-                    f"""select
-                    {fields_select_sql},
-                    csv_errors.errors
-                    from {{}} t
-                    join csv_errors
-                    on t.id = csv_errors.record_id
-                    where csv_errors.source_id=%s"""
-                ).format(sql.Identifier(csv_table_name)),
-                [source_id],
-            )
-            headers = [desc[0] for desc in cur.description]
+    db_conn = get_db()
+    with db_conn.cursor() as cur:
+        cur.execute("select type, filename from sources where id = %s", [source_id])
+        row = cur.fetchone()
+    if row is None:
+        return abort(404)
+    source_type = Type(row[0])
+    filename = os.path.splitext(row[1])[0] + '_errors.csv'
+    csv_table_name = DATA_MAPPING[source_type].csv_table
+    model = DATA_MAPPING[source_type].model
+    fields = [f.lower() for f in model.model_fields.keys()]+['isdeleted']
+    fields_select_sql = ", ".join(fields)
+    query = sql.SQL(
+        f"""select
+        {fields_select_sql},
+        csv_errors.errors::text as errors
+        from {{}} t
+        join csv_errors
+        on t.source_id = csv_errors.source_id and t.id = csv_errors.record_id
+        where csv_errors.source_id=%s and t.source_id=%s"""
+    ).format(sql.Identifier(csv_table_name))
+    # gzip;q=0 refuses it
+    gzipped = request.accept_encodings["gzip"] > 0
+
+    @stream_with_context
+    def generate():
+        csv_data = io.StringIO()
+        csv_writer = csv.writer(csv_data)
+        # raw deflate with a gzip header and trailer
+        compressor = zlib.compressobj(wbits=31) if gzipped else None
+
+        def flush_chunk(final=False):
+            chunk = csv_data.getvalue().encode()
+            csv_data.seek(0)
+            csv_data.truncate()
+            if compressor:
+                chunk = compressor.compress(chunk)
+                if final:
+                    chunk += compressor.flush()
+            return chunk
+
+        csv_writer.writerow([*fields, "errors"])
+        yield flush_chunk()
+        # server-side cursor, only a chunk of rows is held at a time
+        with db_conn.cursor(name="csv_errors_download") as cur:
+            cur.execute(query, [source_id, source_id])
+            while True:
+                rows = cur.fetchmany(CSV_ERRORS_DOWNLOAD_CHUNK_SIZE)
+                if not rows:
+                    break
+                csv_writer.writerows(rows)
+                yield flush_chunk()
+        yield flush_chunk(final=True)
+
+    response = Response(generate(), mimetype="application/csv")
+    response.headers.set("Content-Disposition", "attachment", **_attachment(filename))
+    response.vary.add("Accept-Encoding")
+    if gzipped:
+        response.content_encoding = "gzip"
+    return response
+
+
+def _stream_query_rows(cur, headers: list[str], rows: list, format: str):
+    try:
+        data = io.StringIO()
+        csv_writer = csv.writer(data)
+        if format == "csv":
             csv_writer.writerow(headers)
-            rows = cur.fetchall()
-            for row in rows:
-                csv_writer.writerow(row)
-    csv_data.seek(0)
-    return send_file(
-        io.BytesIO(csv_data.read().encode()),
-        "application/csv",
-        True,
-        filename,
-    )
+        while rows:
+            if format == "csv":
+                csv_writer.writerows(rows)
+            else:
+                for row in rows:
+                    data.write(json.dumps(dict(zip(headers, row)), default=str))
+                    data.write("\n")
+            yield data.getvalue().encode()
+            data.seek(0)
+            data.truncate()
+            rows = cur.fetchmany(QUERY_EXPORT_CHUNK_SIZE)
+        if data.tell():
+            # the csv header of a query without rows
+            yield data.getvalue().encode()
+    finally:
+        cur.close()
 
 
 def query_view():
@@ -97,17 +230,62 @@ def query_view():
     error = None
     rows = []
     headers = []
+    truncated = False
     sql = ""
     if request.method == "POST" and request.form.get("sql"):
         sql = request.form.get("sql")
         assert sql is not None
-        with get_db_reader_conn(config) as db_conn:
-            with db_conn.cursor() as cur:
-                try:
-                    cur.execute(sql)
-                    headers = [desc[0] for desc in cur.description]
-                    rows = cur.fetchall()
-                except Exception as e:
-                    error = str(e)
-
-    return render_template("sql.j2", headers=headers, rows=rows, error=error, sql=sql)
+        export = request.form.get("export")
+        if export not in QUERY_EXPORT_MIMETYPES:
+            export = None
+        cache = get_query_cache(config) if not export else None
+        cache_key = query_cache_key(sql, config.query_row_limit)
+        cached = cache.get(cache_key) if cache else None
+        if cached is not None:
+            headers, rows, truncated = cached
+        else:
+            db_conn = get_reader_db()
+            try:
+                with db_conn.cursor() as cur:
+                    # per FETCH, so long exports aren't cut short
+                    cur.execute(
+                        "set local statement_timeout = %s",
+                        [config.query_statement_timeout],
+                    )
+                # server-side cursor, rows are only read as far as they are needed
+                cur = db_conn.cursor(name="query_view")
+                cur.execute(sql)
+                if export:
+                    rows = cur.fetchmany(QUERY_EXPORT_CHUNK_SIZE)
+                else:
+                    rows = cur.fetchmany(config.query_row_limit + 1)
+                headers = [desc[0] for desc in cur.description]
+            except Exception as e:
+                error = str(e)
+            else:
+                if export:
+                    response = Response(
+                        stream_with_context(
+                            _stream_query_rows(cur, headers, rows, export)
+                        ),
+                        mimetype=QUERY_EXPORT_MIMETYPES[export],
+                    )
+                    response.headers.set(
+                        "Content-Disposition", "attachment", filename=f"query.{export}"
+                    )
+                    return response
+                cur.close()
+                truncated = len(rows) > config.query_row_limit
+                rows = rows[: config.query_row_limit]
+                if cache:
+                    cache.set(cache_key, (headers, rows, truncated))
+
+    return render_template(
+        "sql.j2",
+        headers=headers,
+        rows=rows,
+        error=error,
+        sql=sql,
+        truncated=truncated,
+        row_limit=config.query_row_limit,
+    )
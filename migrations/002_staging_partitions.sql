@@ -0,0 +1,48 @@
+-- Index what the importers and the web views filter on, and partition the
+-- staging and csv_errors tables by source so the rows of old sources can be
+-- dropped instantly with `idfp drop-partitions`.
+--
+-- Each source gets its own partition, created by the importer when the source
+-- is. The existing rows are kept in a legacy partition bounded by the last
+-- source id, there is no default partition: attaching a partition would lock
+-- it against readers for the duration. A check constraint matching the bounds
+-- spares the scan when attaching it. Truncate it once its rows aren't needed
+-- anymore.
+
+-- written by the importers
+alter table area_csv add column if not exists errors json null;
+alter table strain_csv add column if not exists errors json null;
+
+do $$
+declare
+    max_source_id int := (select coalesce(max(id), 0) from sources);
+    legacy_table text;
+begin
+    foreach legacy_table in array array['area_csv', 'strain_csv', 'csv_errors'] loop
+        -- no partition takes null keys, these rows had no source anyway
+        execute format('update %I set source_id = 0 where source_id is null', legacy_table);
+        execute format('alter table %I rename to %I', legacy_table, legacy_table || '_legacy');
+        execute format(
+            'alter table %I add constraint %I check (source_id is not null and source_id < %s)',
+            legacy_table || '_legacy', legacy_table || '_legacy_source_id_check', max_source_id + 1
+        );
+        execute format(
+            'create table %I (like %I including defaults) partition by range (source_id)',
+            legacy_table, legacy_table || '_legacy'
+        );
+        execute format('alter sequence %I owned by %I.id', legacy_table || '_id_seq', legacy_table);
+        execute format(
+            'alter table %I attach partition %I for values from (minvalue) to (%s)',
+            legacy_table, legacy_table || '_legacy', max_source_id + 1
+        );
+    end loop;
+end $$;
+
+-- rows still to process, in id order for `--workers` ranges
+create index area_csv_pending_idx on area_csv (source_id, lower(isdeleted), id) where processed_at = 0;
+create index strain_csv_pending_idx on strain_csv (source_id, lower(isdeleted), id) where processed_at = 0;
+-- marking processed rows, /csv-errors/download joins
+create index area_csv_source_id_id_idx on area_csv (source_id, id);
+create index strain_csv_source_id_id_idx on strain_csv (source_id, id);
+-- /sources error flags, /csv-errors/download
+create index csv_errors_source_id_record_id_idx on csv_errors (source_id, record_id);
@@ -0,0 +1,12 @@
+-- Number of csv_errors rows of each source, kept up to date by the importers
+-- so that listing the sources never has to look at csv_errors.
+alter table sources add column csv_errors_count int not null default 0;
+
+update sources
+set csv_errors_count = counts.csv_errors_count
+from (
+    select source_id, count(*) as csv_errors_count
+    from csv_errors
+    group by source_id
+) counts
+where sources.id = counts.source_id;
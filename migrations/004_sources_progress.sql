@@ -0,0 +1,9 @@
+-- Processing progress of each source. processed_at used to be set when the
+-- processing started, it is now set when it finishes and
+-- processing_started_at records the start. number_of_processed_records counts
+-- the staged rows committed so far, number_of_records the staged rows.
+alter table sources
+    add column processing_started_at timestamp with time zone null,
+    add column number_of_processed_records int not null default 0;
+
+update sources set processing_started_at = processed_at;
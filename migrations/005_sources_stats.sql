@@ -0,0 +1,3 @@
+-- Counters and timings of each import phase of a source, by phase name:
+-- {"copy": {"duration": 1.2, "rows_in": 1000, ...}, "insert": {...}, ...}
+alter table sources add column stats jsonb not null default '{}';
@@ -0,0 +1,6 @@
+-- Sources staged by the web upload wait for an `idfp worker` to process them.
+-- A queued source is done once processed_at is set.
+alter table sources add column queued_at timestamp with time zone null;
+
+create index sources_queue_idx on sources (id)
+where queued_at is not null and processed_at is null;
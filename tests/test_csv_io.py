@@ -0,0 +1,155 @@
+import bz2
+import csv
+import gzip
+import io
+import lzma
+import os
+import threading
+
+import pytest
+
+from idfp.importers.csv_io import (
+    FileRange,
+    SourceStampedCsv,
+    csv_filename,
+    detect_compression,
+    open_csv,
+    split_csv,
+)
+
+# quoted newlines, doubled quotes and delimiters within quotes
+RECORDS = [
+    ["IsDeleted", "ExternalIdentifier", "Name"],
+    ["False", "EXT1", "plain"],
+    ["False", "EXT2", "two\nlines"],
+    ["True", "EXT3", 'say "hi",\nthen\n\nleave'],
+    ["False", "EXT4", '""'],
+    ["False", "EXT5", "a,b"],
+    ["False", "EXT6", '"\n"'],
+]
+
+
+def write_csv(records: list[list[str]]) -> str:
+    data = io.StringIO()
+    csv.writer(data, lineterminator="\n").writerows(records)
+    return data.getvalue()
+
+
+@pytest.mark.parametrize("size", [-1, 1, 5, 64])
+def test_source_stamped_csv_prefixes_every_record(size: int):
+    stamped = SourceStampedCsv(io.StringIO(write_csv(RECORDS)), [42, 0])
+    chunks = []
+    while chunk := stamped.read(size):
+        chunks.append(chunk)
+        if size < 0:
+            break
+    assert list(csv.reader(io.StringIO("".join(chunks)))) == [
+        ["42", "0", *record] for record in RECORDS
+    ]
+
+
+@pytest.mark.parametrize("chunk_bytes", [1, 7, 16, 50, 1024])
+def test_split_csv_ranges_hold_whole_records(tmp_path, chunk_bytes: int):
+    # enough records for the small chunks to end within quoted newlines
+    records = [RECORDS[0], *RECORDS[1:] * 20]
+    path = tmp_path / "area.csv"
+    path.write_text(write_csv(records))
+
+    header_end, ranges = split_csv(str(path), chunk_bytes=chunk_bytes)
+
+    assert path.read_bytes()[:header_end].decode() == write_csv(records[:1])
+    assert ranges[0][0] == header_end
+    assert ranges[-1][1] == path.stat().st_size
+    assert all(end == start for (_, end), (start, _) in zip(ranges, ranges[1:]))
+    staged = []
+    for start, end in ranges:
+        with io.TextIOWrapper(
+            io.BufferedReader(FileRange(str(path), start, end)), newline=""
+        ) as csv_fd:
+            stamped = SourceStampedCsv(csv_fd, [42, 0]).read()
+            staged.extend(csv.reader(io.StringIO(stamped)))
+    assert staged == [["42", "0", *record] for record in records[1:]]
+
+
+COMPRESSORS = {
+    None: lambda data: data,
+    "gzip": gzip.compress,
+    "bz2": bz2.compress,
+    "xz": lzma.compress,
+}
+
+
+def zstd_compress(data: bytes) -> bytes:
+    zstandard = pytest.importorskip("zstandard")
+    # two frames, read as one stream
+    middle = len(data) // 2
+    compressor = zstandard.ZstdCompressor()
+    return compressor.compress(data[:middle]) + compressor.compress(data[middle:])
+
+
+def read_records(fo) -> list[list[str]]:
+    with open_csv(fo) as csv_fo:
+        return list(csv.reader(csv_fo))
+
+
+@pytest.mark.parametrize("compression", list(COMPRESSORS))
+def test_open_csv_round_trip(tmp_path, compression):
+    path = tmp_path / "records.csv"
+    path.write_bytes(COMPRESSORS[compression](write_csv(RECORDS).encode()))
+    with open(path, "rb") as fo:
+        assert detect_compression(fo) == compression
+        # detecting doesn't consume the stream
+        assert fo.tell() == 0
+        assert read_records(fo) == RECORDS
+
+
+def test_open_csv_zstd_round_trip(tmp_path):
+    path = tmp_path / "records.csv.zst"
+    path.write_bytes(zstd_compress(write_csv(RECORDS).encode()))
+    with open(path, "rb") as fo:
+        assert detect_compression(fo) == "zstd"
+        assert read_records(fo) == RECORDS
+
+
+def test_open_csv_concatenated_gzip_members():
+    data = write_csv(RECORDS).encode()
+    middle = len(data) // 2
+    fo = io.BytesIO(gzip.compress(data[:middle]) + gzip.compress(data[middle:]))
+    assert read_records(fo) == RECORDS
+
+
+@pytest.mark.parametrize("compression", [*COMPRESSORS, "zstd"])
+def test_open_csv_reads_a_pipe(compression):
+    data = write_csv(RECORDS).encode()
+    if compression == "zstd":
+        data = zstd_compress(data)
+    else:
+        data = COMPRESSORS[compression](data)
+    read_fd, write_fd = os.pipe()
+
+    def write():
+        with os.fdopen(write_fd, "wb") as write_fo:
+            write_fo.write(data)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    # like sys.stdin.buffer of `idfp import-csv -`, no seek and no peek
+    with os.fdopen(read_fd, "rb", buffering=0) as read_fo:
+        assert not read_fo.seekable()
+        assert not hasattr(read_fo, "peek")
+        assert read_records(read_fo) == RECORDS
+    writer.join()
+
+
+@pytest.mark.parametrize(
+    "filename, expected",
+    [
+        ("area.csv", "area.csv"),
+        ("area.csv.gz", "area.csv"),
+        ("area.csv.bz2", "area.csv"),
+        ("area.csv.xz", "area.csv"),
+        ("area.csv.zst", "area.csv"),
+    ],
+)
+def test_csv_filename(filename: str, expected: str):
+    assert csv_filename(filename) == expected
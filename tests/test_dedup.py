@@ -0,0 +1,116 @@
+"""Checks of the dedup phase against a database, skipped unless
+IDFP_TEST_CONFIG points to the config of a database dedicated to tests: the
+entity tables are emptied."""
+import csv
+import io
+import os
+
+import pytest
+
+from idfp.config import configure
+from idfp.db import get_db_conn
+from idfp.definitions import DATA_MAPPING, ProcessMode, Type
+from idfp.importers.base import import_and_process_csv
+from idfp.importers.validation import get_batch_validator
+
+from generate import HEADERS, KEY_FIELDS, generate_rows
+
+pytestmark = pytest.mark.skipif(
+    not os.environ.get("IDFP_TEST_CONFIG"), reason="IDFP_TEST_CONFIG isn't set"
+)
+
+
+@pytest.fixture
+def db_conn():
+    with open(os.environ["IDFP_TEST_CONFIG"], "rb") as config_fo:
+        config = configure(config_fo)
+    db_conn = get_db_conn(config)
+    with db_conn.cursor() as cur:
+        cur.execute("truncate areas")
+    db_conn.commit()
+    yield db_conn
+    db_conn.close()
+
+
+def import_rows(db_conn, rows: list[list[str]], mode: ProcessMode) -> int:
+    data = io.StringIO()
+    csv.writer(data).writerows(rows)
+    data.seek(0)
+    return import_and_process_csv(
+        db_conn=db_conn, type=Type.AREA, csv_fo=data, mode=mode, filename="test.csv"
+    )
+
+
+def fetch_names(db_conn) -> dict[str, str]:
+    with db_conn.cursor() as cur:
+        cur.execute("select externalidentifier, name from areas")
+        names = dict(cur.fetchall())
+    db_conn.commit()
+    return names
+
+
+@pytest.mark.parametrize("mode", list(ProcessMode))
+def test_generated_tombstones_delete_their_keys(db_conn, mode: ProcessMode):
+    # tombstones of the generator have no UpdatedDate, most upserts do
+    headers, *rows = generate_rows(Type.AREA, 2000, delete_ratio=0.2, seed=1)
+    records = [dict(zip(headers, row)) for row in rows]
+    model_fields = list(DATA_MAPPING[Type.AREA].model.model_fields)
+    validator = get_batch_validator(DATA_MAPPING[Type.AREA].model)
+    upserts = [r for r in records if r["IsDeleted"] == "False"]
+    # COPY stages empty fields as nulls
+    results = validator.validate(
+        [{f: r[f] or None for f in model_fields} for r in upserts]
+    )
+    written = {
+        r[KEY_FIELDS[Type.AREA]]
+        for r, result in zip(upserts, results)
+        if isinstance(result, dict)
+    }
+    deleted = {r[KEY_FIELDS[Type.AREA]] for r in records if r["IsDeleted"] == "True"}
+    assert deleted & written
+
+    import_rows(db_conn, [headers, *rows], mode)
+
+    assert set(fetch_names(db_conn)) == written - deleted
+
+
+@pytest.mark.parametrize("mode", list(ProcessMode))
+def test_latest_version_wins(db_conn, mode: ProcessMode):
+    def row(key: str, updated: str, name: str, is_deleted: str = "False"):
+        values = {
+            "IsDeleted": is_deleted,
+            "LicenseeId": "1",
+            "ExternalIdentifier": key,
+            "CreatedBy": "me",
+            "CreatedDate": "2024-01-01",
+            "UpdatedDate": updated,
+            "Name": name,
+            "AreaId": "1",
+            "IsQuarantine": "False",
+        }
+        return [values.get(h, "") for h in HEADERS[Type.AREA]]
+
+    source_id = import_rows(
+        db_conn,
+        [
+            HEADERS[Type.AREA],
+            row("A", "2024-01-05", "a"),
+            row("A", "", "", is_deleted="True"),
+            row("B", "2024-01-05", "b-new"),
+            row("B", "2024-01-02", "b-old"),
+            row("C", "2024-01-05", "c-old"),
+            row("C", "yesterday", "c-new"),
+            row("D", "", "d-old"),
+            row("D", "2024-01-02", "d-new"),
+        ],
+        mode,
+    )
+
+    assert fetch_names(db_conn) == {"B": "b-new", "D": "d-new"}
+    with db_conn.cursor() as cur:
+        cur.execute(
+            "select count(*) from csv_errors where source_id = %s", [source_id]
+        )
+        # the date of c-new is reported rather than superseded
+        assert cur.fetchone()[0] == 1
+    db_conn.commit()
@@ -0,0 +1,139 @@
+import os
+import pickle
+import stat
+
+import pytest
+
+from idfp.web import query_cache
+from idfp.web.query_cache import (
+    FileQueryCache,
+    MemoryQueryCache,
+    check_query_cache_dir,
+    normalize_sql,
+    query_cache_key,
+)
+
+
+def test_normalize_sql_collapses_whitespace():
+    assert normalize_sql("select  *\n\n   from\tareas  ;  ") == "select *\nfrom areas"
+
+
+@pytest.mark.parametrize(
+    "literal",
+    [
+        "'a   b'",
+        "'it''s  \n  x'",
+        "E'it\\'s   x'",
+        '"Area  Name"',
+        "$$ a   b $$",
+        "$tag$ a  $$  b $tag$",
+    ],
+)
+def test_normalize_sql_keeps_quoted_whitespace(literal: str):
+    assert normalize_sql(f"select  {literal}  from areas") == (
+        f"select {literal} from areas"
+    )
+
+
+@pytest.mark.parametrize(
+    "comment", ["-- don't\n", "/* it's */", "/* \"quoted */", "-- $$\n"]
+)
+def test_normalize_sql_ignores_quotes_in_comments(comment: str):
+    assert normalize_sql(f"select {comment} 'a   b'") != normalize_sql(
+        f"select {comment} 'a b'"
+    )
+    assert normalize_sql(f"select {comment} 'a   b'").endswith("'a   b'")
+
+
+def test_query_cache_key_depends_on_the_row_limit():
+    assert query_cache_key("select 1", 10) != query_cache_key("select 1", 20)
+    assert query_cache_key("select  1;", 10) == query_cache_key("select 1", 10)
+
+
+VALUE = {"headers": ["name"], "rows": [["x" * 100]]}
+
+
+@pytest.fixture
+def now(monkeypatch):
+    clock = [1_000_000.0]
+    monkeypatch.setattr(query_cache.time, "time", lambda: clock[0])
+    return clock
+
+
+@pytest.fixture(params=["memory", "file"])
+def make_cache(request, tmp_path):
+    def make(ttl: int, max_bytes: int):
+        if request.param == "memory":
+            return MemoryQueryCache(ttl, max_bytes)
+        return FileQueryCache(ttl, max_bytes, str(tmp_path / "cache"))
+
+    return make
+
+
+def entry_size() -> int:
+    # the file cache pickles the expiry time along with the value
+    return len(pickle.dumps((0.0, VALUE)))
+
+
+def test_query_cache_entries_expire(make_cache, now):
+    cache = make_cache(ttl=60, max_bytes=1024 * 1024)
+    cache.set("a", VALUE)
+    now[0] += 59
+    assert cache.get("a") == VALUE
+    now[0] += 2
+    assert cache.get("a") is None
+    # a new value starts a new ttl
+    cache.set("a", VALUE)
+    assert cache.get("a") == VALUE
+
+
+def test_query_cache_evicts_the_least_recently_used(make_cache, now):
+    cache = make_cache(ttl=60, max_bytes=entry_size() * 5 // 2)
+    cache.set("a", VALUE)
+    cache.set("b", VALUE)
+    if isinstance(cache, FileQueryCache):
+        # the modification times order the entries, make them distinct
+        os.utime(cache._path("a"), (1, 1))
+        os.utime(cache._path("b"), (2, 2))
+    assert cache.get("a") == VALUE
+    cache.set("c", VALUE)
+    assert cache.get("b") is None
+    assert cache.get("a") == VALUE
+    assert cache.get("c") == VALUE
+
+
+def test_query_cache_skips_values_over_the_limit(make_cache, now):
+    cache = make_cache(ttl=60, max_bytes=entry_size() // 2)
+    cache.set("a", VALUE)
+    assert cache.get("a") is None
+
+
+def test_query_cache_clear(make_cache, now):
+    cache = make_cache(ttl=60, max_bytes=1024 * 1024)
+    cache.set("a", VALUE)
+    cache.set("b", VALUE)
+    cache.clear()
+    assert cache.get("a") is None
+    assert cache.get("b") is None
+
+
+def test_check_query_cache_dir_creates_a_private_directory(tmp_path):
+    directory = tmp_path / "cache"
+    check_query_cache_dir(str(directory))
+    assert stat.S_IMODE(directory.stat().st_mode) & 0o077 == 0
+
+
+@pytest.mark.parametrize("mode", [0o770, 0o730, 0o777, 0o703])
+def test_check_query_cache_dir_refuses_a_shared_directory(tmp_path, mode: int):
+    directory = tmp_path / "cache"
+    directory.mkdir()
+    directory.chmod(mode)
+    with pytest.raises(PermissionError):
+        check_query_cache_dir(str(directory))
+    with pytest.raises(PermissionError):
+        FileQueryCache(60, 1024, str(directory))
+
+
+def test_check_query_cache_dir_needs_a_directory():
+    with pytest.raises(ValueError):
+        check_query_cache_dir("")
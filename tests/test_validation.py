@@ -0,0 +1,122 @@
+import typing as t
+
+import pydantic
+import pytest
+from pydantic import BaseModel, ValidationError, field_validator
+
+from idfp.importers.validation import BatchValidator
+from idfp.models import Area, Strain
+
+AREA = {
+    "CreatedBy": "me",
+    "UpdatedBy": None,
+    "CreatedDate": "2024-01-01",
+    "UpdatedDate": "2024-01-02",
+    "LicenseeId": "1",
+    "ExternalIdentifier": "A-1",
+    "Name": "area",
+    "AreaId": "10",
+    "IsQuarantine": "False",
+}
+STRAIN = {
+    "CreatedBy": "me",
+    "UpdatedBy": "you",
+    "CreatedDate": "2024-01-01",
+    "UpdatedDate": None,
+    "LicenseeId": "1",
+    "StrainId": "2",
+    "AssociateId": "3",
+    "StrainType": "Hybrid",
+    "Name": "strain",
+}
+
+
+class Batch(BaseModel):
+    Name: str
+    Count: int
+
+    @field_validator("Name")
+    @classmethod
+    def strip_name(cls, value: str) -> str:
+        if not value.strip():
+            raise ValueError("blank name")
+        return value.strip()
+
+
+BATCH = {"Name": " batch ", "Count": "4"}
+
+VALID = {Area: AREA, Strain: STRAIN, Batch: BATCH}
+INVALID = {
+    Area: [
+        {**AREA, "CreatedDate": "yesterday"},
+        {**AREA, "LicenseeId": "one", "Name": "n" * 76},
+        {**AREA, "CreatedBy": None, "IsQuarantine": None},
+        {k: v for k, v in AREA.items() if k != "AreaId"},
+    ],
+    Strain: [
+        {**STRAIN, "StrainType": "Ruderalis"},
+        {**STRAIN, "StrainId": "2.5", "UpdatedDate": "2024-13-01"},
+    ],
+    Batch: [
+        {**BATCH, "Name": "   "},
+        {**BATCH, "Name": "   ", "Count": "four"},
+    ],
+}
+
+
+def validate_each(
+    model: type[pydantic.BaseModel], rows: list[dict[str, t.Any]]
+) -> list[t.Union[dict[str, t.Any], ValidationError]]:
+    results = []
+    for row in rows:
+        try:
+            results.append(dict(model(**row)))
+        except ValidationError as err:
+            results.append(err)
+    return results
+
+
+def assert_same_results(model: type[pydantic.BaseModel], rows: list[dict[str, t.Any]]):
+    results = BatchValidator(model).validate(rows)
+    expected = validate_each(model, rows)
+    assert len(results) == len(expected)
+    for result, expected_result in zip(results, expected):
+        if isinstance(expected_result, ValidationError):
+            assert isinstance(result, ValidationError)
+            assert result.json() == expected_result.json()
+        else:
+            assert result == expected_result
+
+
+def test_models_without_validators_use_a_typed_dict():
+    assert BatchValidator(Area).row_type is not Area
+    assert BatchValidator(Strain).row_type is not Strain
+    assert BatchValidator(Batch).row_type is Batch
+
+
+@pytest.mark.parametrize("model", list(VALID))
+def test_valid_rows(model: type[pydantic.BaseModel]):
+    assert_same_results(model, [VALID[model]] * 3)
+
+
+@pytest.mark.parametrize("model", list(INVALID))
+def test_invalid_rows(model: type[pydantic.BaseModel]):
+    assert_same_results(model, INVALID[model])
+
+
+@pytest.mark.parametrize("model", list(VALID))
+def test_mixed_batch(model: type[pydantic.BaseModel]):
+    rows = [VALID[model]]
+    for row in INVALID[model]:
+        rows.extend([row, VALID[model]])
+    assert_same_results(model, rows)
+
+
+def test_values_follow_the_model_fields():
+    validator = BatchValidator(Strain)
+    [row] = validator.validate([STRAIN])
+    values = validator.values(row)
+    assert len(values) == len(Strain.model_fields)
+    # enum members are written as their values
+    assert values[validator.fields.index("StrainType")] == "Hybrid"
+    assert values[validator.fields.index("StrainId")] == 2